@@ -1,7 +1,14 @@
-import os, json, calendar, datetime, uuid, re, queue, threading, time
-from flask import Flask, render_template_string, request, redirect, url_for, session, Response, jsonify, send_from_directory
+import os, json, calendar, datetime, uuid, re, queue, threading, time, math, hashlib, unicodedata, bisect, base64, atexit, csv, io
+from flask import Flask, render_template_string, request, redirect, url_for, session, Response, jsonify, send_from_directory, g
 from werkzeug.utils import secure_filename
-from functools import wraps
+from werkzeug.middleware.proxy_fix import ProxyFix
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+import html
+from functools import wraps, lru_cache
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from werkzeug.security import check_password_hash, generate_password_hash
 
 # --- CONFIGURACIÓN ---
@@ -12,11 +19,17 @@ app.config['SESSION_COOKIE_SECURE']       = False  # True en produccion con HTTP
 app.config['PERMANENT_SESSION_LIFETIME']  = datetime.timedelta(days=5)
 app.config['SEND_FILE_MAX_AGE_DEFAULT']   = 86400   # cache estaticos 1 dia
 app.config['TEMPLATES_AUTO_RELOAD']       = False   # no recargar plantillas en prod
+# Proxies de confianza delante de la app (Render: 1). Solo se cree la entrada de
+# X-Forwarded-For que añade el último de ellos; el resto lo puede inventar el cliente.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', '1'))
+if TRUSTED_PROXIES > 0: app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=0)
 app.jinja_env.auto_reload                 = False
 app.jinja_env.cache_size                  = 400     # cachear hasta 400 plantillas compiladas
 
 # Cache de render_template_string: evita recompilar Jinja2 en cada request
 from jinja2 import Environment
+try: import fcntl   # bloqueo entre procesos para las migraciones (no existe en Windows)
+except ImportError: fcntl = None
 _tpl_cache: dict = {}
 
 def render_cached(template_str: str, **kwargs):
@@ -27,23 +40,357 @@ def render_cached(template_str: str, **kwargs):
 
 # --- ADMIN HARDCODED ---
 ADMIN_USER      = 'ogmhabas'
-ADMIN_PASS_HASH = 'scrypt:32768:8:1$Y2Jetdw7JfJ9Q4ql$e2306faecea53adcfecb39bcf990fabba330526e35665bea8072e8efada137e1b55731bf0a8c4766cdaed8f2d72e40832797980845f0758304ad0b5c49ea75c0'
+ADMIN_PASS_HASH = os.environ.get('ADMIN_PASS_HASH') or 'scrypt:32768:8:1$Y2Jetdw7JfJ9Q4ql$e2306faecea53adcfecb39bcf990fabba330526e35665bea8072e8efada137e1b55731bf0a8c4766cdaed8f2d72e40832797980845f0758304ad0b5c49ea75c0'
+
+# --- HASHING DE CONTRASEÑAS (pool de procesos acotado) ---
+# scrypt es CPU pura: se ejecuta fuera de los hilos de gunicorn para que un pico
+# de logins no deje sin hilos al resto de la web. Si la cola está llena se
+# responde 503 al momento en vez de apilar peticiones.
+# Cada hash en curso o en cola tiene un hilo de gunicorn esperando: el total se
+# limita por debajo de WEB_THREADS (los --threads de render.yaml) para que
+# siempre quede al menos un hilo libre sirviendo páginas.
+WEB_THREADS    = max(1, int(os.environ.get('WEB_THREADS', '4')))
+HASH_WORKERS   = max(1, int(os.environ.get('HASH_WORKERS', '1')))
+HASH_MAX_QUEUE = max(0, int(os.environ.get('HASH_MAX_QUEUE', str(WEB_THREADS - 2 - HASH_WORKERS))))   # hashes esperando, como máximo
+HASH_SLOTS     = max(1, min(HASH_WORKERS + HASH_MAX_QUEUE, WEB_THREADS - 1))
+HASH_TIMEOUT   = 10  # segundos
+
+class HashPoolBusy(Exception):
+    """El pool de hashing está saturado (o roto); el cliente debe reintentar."""
+
+_hash_pool = None
+_hash_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(HASH_SLOTS)
+_hash_stats = {'in_flight': 0, 'peak': 0, 'completed': 0, 'rejected': 0, 'errors': 0}
+
+def _get_hash_pool():
+    """Crea el pool en el primer uso: así cada worker de gunicorn tiene el suyo tras el fork."""
+    global _hash_pool
+    with _hash_lock:
+        if _hash_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=ctx)
+        return _hash_pool
+
+def _release_hash_slot(future=None):
+    with _hash_lock:
+        _hash_stats['in_flight'] -= 1
+        if future is not None and not future.cancelled() and future.exception() is None: _hash_stats['completed'] += 1
+    _hash_slots.release()
+
+def _submit_to_hash_pool(fn, *args):
+    """Reserva un hueco y encola el trabajo sin esperarlo. HashPoolBusy si no hay hueco."""
+    global _hash_pool
+    if not _hash_slots.acquire(blocking=False):
+        with _hash_lock: _hash_stats['rejected'] += 1
+        raise HashPoolBusy()
+    with _hash_lock:
+        _hash_stats['in_flight'] += 1
+        _hash_stats['peak'] = max(_hash_stats['peak'], _hash_stats['in_flight'])
+    try: future = _get_hash_pool().submit(fn, *args)
+    except (BrokenProcessPool, RuntimeError):
+        with _hash_lock: _hash_pool = None; _hash_stats['errors'] += 1
+        _release_hash_slot()
+        raise HashPoolBusy()
+    # El hueco se libera cuando el trabajo termina de verdad, no cuando el cliente
+    # deja de esperar: si no, tras un timeout el atasco real superaría la cola.
+    future.add_done_callback(_release_hash_slot)
+    return future
+
+def _run_in_hash_pool(fn, *args):
+    global _hash_pool
+    future = _submit_to_hash_pool(fn, *args)
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except BrokenProcessPool:
+        with _hash_lock: _hash_pool = None; _hash_stats['errors'] += 1
+        raise HashPoolBusy()
+    except FutureTimeout:
+        future.cancel()   # si aún estaba en cola no llega a ejecutarse
+        with _hash_lock: _hash_stats['errors'] += 1
+        raise HashPoolBusy()
+
+# Parámetros del hash: se calibran una sola vez contra HASH_TARGET_MS en esta
+# máquina y se guardan en hash_params.json, así todos los workers usan el mismo
+# método. Hasta tenerlo se usa el defecto de werkzeug.
+# HASH_METHOD fuerza un método concreto (p.ej. 'scrypt:16384:8:1').
+HASH_SCHEME    = os.environ.get('HASH_SCHEME', 'scrypt')          # 'scrypt' o 'pbkdf2'
+HASH_TARGET_MS = float(os.environ.get('HASH_TARGET_MS', '150'))
+PASSWORD_HASH_METHOD = os.environ.get('HASH_METHOD') or 'scrypt:32768:8:1'
+HASH_PARAMS_FILE      = 'hash_params.json'
+HASH_PARAMS_LOCK_FILE = 'hash_params.lock'
+
+SCRYPT_N_RANGE   = (2 ** 14, 2 ** 16)   # suelo de seguridad / techo de memoria (64 MiB con r=8)
+PBKDF2_MIN_ITERS = 600_000
+
+def _bench(fn, rounds=2):
+    best = float('inf')
+    for _ in range(rounds):
+        t0 = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+def calibrate_password_hashing(target_ms=HASH_TARGET_MS, scheme=HASH_SCHEME):
+    """Elige el coste más alto cuyo tiempo de verificación no pase de target_ms en este host."""
+    salt = b'calibration-salt'
+    if scheme == 'pbkdf2':
+        sample = 100_000
+        ms = _bench(lambda: hashlib.pbkdf2_hmac('sha256', b'password', salt, sample))
+        iters = max(PBKDF2_MIN_ITERS, int(sample * target_ms / ms) // 10_000 * 10_000)
+        return f'pbkdf2:sha256:{iters}'
+    n_min, n_max = SCRYPT_N_RANGE
+    ms = _bench(lambda: hashlib.scrypt(b'password', salt=salt, n=n_min, r=8, p=1, maxmem=132 * n_min * 8))
+    n = n_min
+    while n * 2 <= n_max and ms * (n * 2) / n_min <= target_ms: n *= 2   # el coste escala lineal con N
+    return f'scrypt:{n}:8:1'
+
+def _saved_hash_method():
+    """Método calibrado guardado, si se calibró con el mismo esquema y objetivo."""
+    try:
+        with open(HASH_PARAMS_FILE, encoding='utf-8') as f: saved = json.load(f)
+    except (OSError, ValueError): return None
+    if not isinstance(saved, dict) or saved.get('scheme') != HASH_SCHEME or saved.get('target_ms') != HASH_TARGET_MS: return None
+    return saved.get('method') or None
+
+def _calibrate_in_background():
+    """El primer worker calibra con el bloqueo cogido; los demás esperan y leen su resultado."""
+    global PASSWORD_HASH_METHOD
+    with open(HASH_PARAMS_LOCK_FILE, 'w') as lock:
+        if fcntl: fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            method = _saved_hash_method()
+            if not method:
+                try: method = calibrate_password_hashing()
+                except (ValueError, MemoryError): return
+                write_json_atomic(HASH_PARAMS_FILE, {'scheme': HASH_SCHEME, 'target_ms': HASH_TARGET_MS, 'method': method})
+            PASSWORD_HASH_METHOD = method
+        finally:
+            if fcntl: fcntl.flock(lock, fcntl.LOCK_UN)
+
+def start_hash_calibration():
+    global PASSWORD_HASH_METHOD
+    if os.environ.get('HASH_METHOD'): return
+    method = _saved_hash_method()
+    if method: PASSWORD_HASH_METHOD = method
+    else: threading.Thread(target=_calibrate_in_background, daemon=True).start()
+
+def _hash_cost(method):
+    """('scrypt', n*r*p) o ('pbkdf2:<digest>', iteraciones) a partir de la cabecera del hash."""
+    scheme, *params = method.split(':')
+    try:
+        if scheme == 'scrypt':
+            n, r, p = (list(map(int, params)) + [2 ** 15, 8, 1][len(params):])[:3]
+            return scheme, n * r * p
+        if scheme == 'pbkdf2':
+            return f"{scheme}:{params[0] if params else 'sha256'}", int(params[1]) if len(params) > 1 else 0
+    except ValueError: pass
+    return scheme, 0
+
+def needs_rehash(pw_hash):
+    """True si el hash usa otro esquema o un coste menor que el calibrado (nunca baja el coste)."""
+    scheme, cost = _hash_cost(pw_hash.split('$', 1)[0])
+    target_scheme, target_cost = _hash_cost(PASSWORD_HASH_METHOD)
+    return scheme != target_scheme or cost < target_cost
+
+def hash_password(password):
+    return _run_in_hash_pool(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def hash_password_later(password, on_done):
+    """Rehash en segundo plano: el login responde ya y on_done(nuevo_hash) se llama al
+    terminar. Best-effort: si el pool está lleno o falla, se reintenta en el próximo login."""
+    try: future = _submit_to_hash_pool(generate_password_hash, password, PASSWORD_HASH_METHOD)
+    except HashPoolBusy: return
+    future.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or on_done(f.result()))
+
+def verify_password(pw_hash, password):
+    return _run_in_hash_pool(check_password_hash, pw_hash, password)
+
+def hash_pool_stats():
+    with _hash_lock: stats = dict(_hash_stats)
+    stats['queued'] = max(0, stats['in_flight'] - HASH_WORKERS)
+    stats.update(workers=HASH_WORKERS, max_queue=HASH_SLOTS - min(HASH_WORKERS, HASH_SLOTS), slots=HASH_SLOTS, method=PASSWORD_HASH_METHOD)
+    return stats
+
+# --- CACHE EN MEMORIA DE FICHEROS JSON ---
+# Las rutas de lectura comparten una copia parseada por fichero. Se invalida al
+# escribir desde este proceso y, como hay varios workers, también cuando cambia
+# el mtime/tamaño del fichero (comprobado como mucho una vez por segundo).
+CACHE_RECHECK_SECS = 1.0
+_json_cache: dict = {}     # {filename: [stamp, checked_at, data]}
+_derived_cache: dict = {}  # {(filename, name): (stamp, value)}
+_json_cache_lock = threading.Lock()
+
+def file_stamp(filename):
+    """Huella barata del fichero: (mtime_ns, tamaño), o None si no existe."""
+    try: st = os.stat(filename)
+    except OSError: return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _cache_entry(filename, parse, fresh=False):
+    now = time.monotonic()
+    entry = _json_cache.get(filename)
+    if entry is not None and not fresh and now - entry[1] < CACHE_RECHECK_SECS: return entry
+    stamp = file_stamp(filename)
+    if entry is not None and entry[0] == stamp:
+        entry[1] = now; return entry
+    entry = [stamp, now, parse()]
+    with _json_cache_lock: _json_cache[filename] = entry
+    return entry
+
+def load_cached(filename, parse):
+    """Datos de `filename` compartidos entre peticiones. Solo lectura: NO mutar el resultado."""
+    return _cache_entry(filename, parse)[2]
+
+def cached_view(filename, name, parse, builder, fresh=False):
+    """Estructura derivada de `filename` (índices, listas filtradas…), recalculada solo si cambia el fichero.
+    fresh=True comprueba el fichero ya (para decisiones de escritura que no admiten el segundo de margen)."""
+    entry = _cache_entry(filename, parse, fresh)
+    hit = _derived_cache.get((filename, name))
+    if hit is not None and hit[0] is entry: return hit[1]
+    value = builder(entry[2])
+    with _json_cache_lock: _derived_cache[(filename, name)] = (entry, value)
+    return value
+
+def invalidate_cache(filename):
+    with _json_cache_lock: _json_cache.pop(filename, None)
+
+def data_version(filename, parse):
+    """Versión del contenido de `filename` (hash corto), igual en todos los workers; base de los ETag."""
+    return cached_view(filename, 'version', parse,
+                       lambda data: hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16])
+
+def conditional(etag, build, last_modified=None):
+    """Respuesta con ETag fuerte (y Last-Modified si se da). Si el cliente ya tiene esa
+    versión responde 304 sin llegar a construir el cuerpo."""
+    inm, ims = request.if_none_match, request.if_modified_since
+    if inm.contains(etag) or (not inm and last_modified and ims and ims >= last_modified):
+        resp = app.response_class(status=304)
+    else:
+        resp = build()
+    resp.set_etag(etag)
+    if last_modified: resp.last_modified = last_modified
+    return resp
+
+def write_json_atomic(filename, data, **dump_args):
+    """Escribe en un temporal junto al fichero y lo sustituye con os.replace: quien lea a la
+    vez (otro worker) ve la versión anterior o la nueva, nunca un fichero a medias."""
+    tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(data, f, **dump_args)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
 
 # --- USUARIOS FILE (reemplaza PRIVATE_USERS hardcoded) ---
 USERS_FILE = 'users.json'
+# Toda lectura-modificación-escritura de users.json (registro, rehash, acciones del
+# admin, volcado diferido) va bajo este lock para no pisarse dentro del worker.
+_users_lock = threading.Lock()
 
 def load_users():
-    """Carga users.json → {username: {hash, created_at, banned}}"""
+    """Carga users.json → {username: {hash, created_at, banned}} (copia nueva, para modificar y guardar)."""
     if not os.path.exists(USERS_FILE): return {}
     try:
         with open(USERS_FILE,'r',encoding='utf-8') as f: return json.load(f)
     except: return {}
 
 def save_users(users):
-    with open(USERS_FILE,'w',encoding='utf-8') as f: json.dump(users, f, indent=2, ensure_ascii=False)
+    write_json_atomic(USERS_FILE, users, indent=2, ensure_ascii=False)
+    invalidate_cache(USERS_FILE)
+
+def users_snapshot():
+    """Mapa usuario → registro en memoria, para lecturas (autorización, login)."""
+    return load_cached(USERS_FILE, load_users)
+
+def fold_text(text):
+    """Texto sin tildes y sin mayúsculas ('Biología' → 'biologia'), para comparar y buscar."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+def normalize_username(name):
+    """Forma canónica para comparar nombres: sin tildes y sin mayúsculas ('José' → 'jose')."""
+    return fold_text(name.strip())
+
+def username_index():
+    """{nombre normalizado: nombre registrado}, mantenido junto a la cache de usuarios."""
+    return cached_view(USERS_FILE, 'name_index', load_users, lambda users: {normalize_username(u): u for u in users})
+
+def resolve_username(name):
+    """Nombre registrado que coincide con `name` ignorando mayúsculas y tildes, o None."""
+    if not name: return None
+    if name in users_snapshot(): return name
+    return username_index().get(normalize_username(name))
 
 def get_user(username):
-    return load_users().get(username)
+    """Registro con el nombre exacto. Las sesiones se autorizan así: una cookie de "Jose"
+    no debe valer para un "José" registrado después. Para lo que teclea el usuario,
+    resolve_username primero."""
+    return users_snapshot().get(username)
+
+# Roster del admin: listas de claves ordenadas, cacheadas con users.json.
+# Cada clave es (orden, nombre) y sirve también de cursor de paginación.
+ROSTER_PAGE_SIZE = 50
+ROSTER_MAX_PAGE  = 200
+
+def _roster_by_name():
+    return cached_view(USERS_FILE, 'roster_name', load_users,
+                       lambda users: sorted((normalize_username(n), n) for n in users))
+
+def _roster_by_created():
+    return cached_view(USERS_FILE, 'roster_created', load_users,
+                       lambda users: sorted((u.get('created_at') or '', n) for n, u in users.items()))
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key), ensure_ascii=False).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inversa de encode_cursor. ValueError si el cursor no es válido."""
+    try: key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError): raise ValueError('cursor')
+    if not isinstance(key, list) or not all(isinstance(k, str) for k in key): raise ValueError('cursor')
+    return tuple(key)
+
+def query_roster(q='', status='all', sort='name', desc=False, cursor=None, limit=ROSTER_PAGE_SIZE):
+    """Página del roster: (filas sin hash, cursor siguiente o None).
+
+    Con `q` se acota por prefijo normalizado con bisect sobre la lista por nombre,
+    así que el coste depende del tamaño de la página, no del número de alumnos."""
+    users = users_snapshot()
+    keys = _roster_by_name()
+    prefix = normalize_username(q) if q else ''
+    if prefix:
+        lo = bisect.bisect_left(keys, (prefix,))
+        hi = bisect.bisect_left(keys, (prefix + '\U0010ffff',))
+        keys = keys[lo:hi]
+        if sort == 'created': keys = sorted((users[n].get('created_at') or '', n) for _, n in keys)
+    elif sort == 'created':
+        keys = _roster_by_created()
+
+    if desc:
+        start = bisect.bisect_left(keys, cursor) - 1 if cursor else len(keys) - 1
+        positions = range(start, -1, -1)
+    else:
+        positions = range(bisect.bisect_right(keys, cursor) if cursor else 0, len(keys))
+
+    rows, last = [], None
+    for i in positions:
+        name = keys[i][1]
+        u = users.get(name)
+        if u is None: continue
+        if status == 'banned' and not u.get('banned'): continue
+        if status == 'active' and u.get('banned'): continue
+        if len(rows) == limit: return rows, encode_cursor(last)
+        rows.append({'username': name, 'created_at': u.get('created_at') or '',
+                     'banned': bool(u.get('banned')), 'message': u.get('message')})
+        last = keys[i]
+    return rows, None
+
+def current_private_user():
+    """(nombre, registro) del alumno de la sesión, resuelto una sola vez por petición en flask.g."""
+    if 'private_user' not in g:
+        name = session.get('private_user')
+        g.private_user = (name, get_user(name) if name else None)
+    return g.private_user
 
 def register_user(username, password):
     """Registra si no existe. Devuelve (ok, msg)."""
@@ -52,41 +399,241 @@ def register_user(username, password):
     if len(password) < 6: return False, 'Mínimo 6 caracteres'
     if not re.match(r'^[\w\sáéíóúÁÉÍÓÚñÑ.\-]{2,30}$', username):
         return False, 'Usuario: solo letras, números, espacios y puntos'
-    users = load_users()
-    # Case-insensitive duplicate check
-    if any(u.lower() == username.lower() for u in users):
+    # Duplicados sin distinguir mayúsculas ni tildes (índice en memoria, antes de pagar el hash)
+    if resolve_username(username):
         return False, 'Ese nombre ya está en uso'
-    users[username] = {
-        'hash': generate_password_hash(password),
-        'created_at': datetime.datetime.utcnow().isoformat(),
-        'banned': False,
-        'message': None,  # mensaje admin en tiempo real
-    }
-    save_users(users)
+    pw_hash = hash_password(password)
+    with _users_lock:
+        users = load_users()   # la cache puede ir hasta un segundo por detrás de otro worker
+        if normalize_username(username) in {normalize_username(u) for u in users}:
+            return False, 'Ese nombre ya está en uso'
+        users[username] = {
+            'hash': pw_hash,
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'banned': False,
+            'message': None,  # mensaje admin en tiempo real
+        }
+        save_users(users)
     return True, 'ok'
 
+def rehash_user(username, old_hash, password):
+    """Regenera el hash con los parámetros actuales tras un login correcto, sin bloquear la
+    respuesta. Solo se guarda si el hash no ha cambiado mientras tanto."""
+    def store(new_hash):
+        with _users_lock:
+            users = load_users()
+            if username in users and users[username].get('hash') == old_hash:
+                users[username]['hash'] = new_hash
+                save_users(users)
+    hash_password_later(password, store)
+
 # SSE: cola de mensajes por usuario  {username: Queue}
 _user_sse_queues: dict = {}
+_sse_online: dict = {}   # {username: nº de streams abiertos en este worker}
+_sse_online_lock = threading.Lock()
 
 def get_sse_queue(username):
     if username not in _user_sse_queues:
         _user_sse_queues[username] = queue.Queue(maxsize=20)
     return _user_sse_queues[username]
 
-def push_message(username, text):
-    """Envía mensaje SSE a un usuario online."""
+def sse_send(username, payload):
+    """Encola el evento. Devuelve False si la cola está llena."""
     q = get_sse_queue(username)
-    try: q.put_nowait({'type':'msg','text': text})
-    except queue.Full: pass
-    # Persiste también en users.json
-    users = load_users()
-    if username in users: users[username]['message'] = text; save_users(users)
+    try: q.put_nowait(payload); return True
+    except queue.Full: return False
+
+def sse_is_online(username):
+    return _sse_online.get(username, 0) > 0
+
+# --- ESCRITURA DIFERIDA DE CAMPOS DE USUARIO ---
+# Efectos secundarios como el último mensaje del admin no justifican reescribir
+# users.json en cada petición: se acumulan en memoria y un hilo los vuelca
+# juntos como mucho USER_FLUSH_DELAY segundos después del primero.
+USER_FLUSH_DELAY = 2.0
+_pending_user_fields: dict = {}   # {username: {campo: valor}}
+_pending_user_lock = threading.Lock()
+_user_flush_wake = threading.Event()
+_user_flusher = None
+
+def defer_user_update(username, **fields):
+    global _user_flusher
+    with _pending_user_lock:
+        _pending_user_fields.setdefault(username, {}).update(fields)
+        if _user_flusher is None:
+            _user_flusher = threading.Thread(target=_user_flush_loop, daemon=True)
+            _user_flusher.start()
+    _user_flush_wake.set()
+
+def flush_user_updates():
+    """Vuelca los cambios pendientes con una sola lectura+escritura de users.json."""
+    with _pending_user_lock:
+        batch = dict(_pending_user_fields)
+        _pending_user_fields.clear()
+    if not batch: return
+    with _users_lock:
+        users = load_users()
+        touched = [name for name in batch if name in users]
+        for name in touched: users[name].update(batch[name])
+        if touched: save_users(users)
+
+def _user_flush_loop():
+    while True:
+        _user_flush_wake.wait()
+        time.sleep(USER_FLUSH_DELAY)   # agrupa la ráfaga
+        _user_flush_wake.clear()
+        flush_user_updates()
+
+atexit.register(flush_user_updates)
+
+# --- BUZÓN PERSISTENTE DE MENSAJES DEL ADMIN ---
+# Un fichero JSONL por usuario en el que solo se añaden líneas: {"id","text","ts"}
+# para cada mensaje y {"ack": id} cuando el navegador confirma que lo ha
+# mostrado. Lo no confirmado se reenvía al conectar al SSE. El fichero se
+# compacta (reescribe) solo cuando crece por encima de INBOX_COMPACT_BYTES.
+INBOX_DIR           = 'inbox'
+INBOX_MAX           = 50        # mensajes sin confirmar que se conservan por usuario
+INBOX_COMPACT_BYTES = 32 * 1024
+INBOX_LOCK_FILE     = os.path.join(INBOX_DIR, '.lock')   # flock entre workers: una compactación no pisa un append
+_inbox_lock = threading.Lock()
+
+def _inbox_path(username):
+    return os.path.join(INBOX_DIR, hashlib.sha1(username.encode('utf-8')).hexdigest() + '.jsonl')
+
+def _read_inbox(path):
+    """Mensajes sin confirmar, en orden de llegada. Al pasar de INBOX_MAX se descarta el más antiguo."""
+    if not os.path.exists(path): return []
+    pending = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try: rec = json.loads(line)
+            except json.JSONDecodeError: continue   # línea a medio escribir
+            if 'ack' in rec: pending.pop(rec['ack'], None)
+            elif 'id' in rec:
+                pending[rec['id']] = rec
+                if len(pending) > INBOX_MAX: del pending[next(iter(pending))]
+    return list(pending.values())
+
+def _compact_inbox(path):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for rec in _read_inbox(path): f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def _append_inbox(username, records):
+    """Añade al final y compacta si hace falta, con el flock cogido: un append de otro
+    worker durante la compactación iría al fichero viejo y se perdería."""
+    path = _inbox_path(username)
+    with _inbox_lock:
+        os.makedirs(INBOX_DIR, exist_ok=True)
+        with open(INBOX_LOCK_FILE, 'w') as lock:
+            if fcntl: fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records))
+                if os.path.getsize(path) > INBOX_COMPACT_BYTES: _compact_inbox(path)
+            finally:
+                if fcntl: fcntl.flock(lock, fcntl.LOCK_UN)
+
+def inbox_add(username, text, **extra):
+    msg = {'id': str(uuid.uuid4()), 'text': text, 'ts': datetime.datetime.utcnow().isoformat(), **extra}
+    _append_inbox(username, [msg])
+    return msg
+
+def inbox_pending(username):
+    with _inbox_lock: return _read_inbox(_inbox_path(username))
+
+def inbox_ack(username, ids):
+    if ids: _append_inbox(username, [{'ack': i} for i in ids])
+
+def push_message(username, text):
+    """Envía mensaje SSE a un usuario; si no está conectado lo recibe al volver (buzón)."""
+    msg = inbox_add(username, text)
+    sse_send(username, {'type':'msg','text': text, 'inbox_id': msg['id']})
+    # Persiste también en users.json (diferido)
+    defer_user_update(username, message=text)
 
 def kick_user(username):
     """Fuerza re-login baneando temporalmente."""
-    q = get_sse_queue(username)
-    try: q.put_nowait({'type':'kick'})
-    except queue.Full: pass
+    sse_send(username, {'type':'kick'})
+
+BULK_USER_ACTIONS = ('ban', 'unban', 'delete', 'message')
+BULK_MAX_USERS    = 5000
+
+def apply_user_action(action, usernames, text=None):
+    """Aplica `action` a varios usuarios con una sola escritura de users.json y
+    después un único reparto de kicks/mensajes por SSE. Devuelve (aplicados, no_encontrados)."""
+    done, missing = [], []
+    with _users_lock:
+        users = load_users()
+        for name in dict.fromkeys(usernames):
+            if name not in users: missing.append(name); continue
+            if action == 'ban': users[name]['banned'] = True
+            elif action == 'unban': users[name]['banned'] = False
+            elif action == 'delete': del users[name]
+            elif action == 'message': users[name]['message'] = text
+            done.append(name)
+        if done: save_users(users)
+    for name in done:
+        if action in ('ban', 'delete'): kick_user(name)
+        elif action == 'message':
+            msg = inbox_add(name, text)
+            sse_send(name, {'type':'msg','text': text, 'inbox_id': msg['id']})
+    return done, missing
+
+
+# --- ANUNCIOS (difusión a todos / a un grupo) ---
+# Cada anuncio va al buzón de cada destinatario: se reenvía al conectar hasta
+# que su navegador, con su sesión, lo confirma. announcements.json es solo el
+# registro para el admin (una línea por anuncio, sin estado por usuario).
+ANNOUNCEMENTS_FILE = 'announcements.json'
+ANNOUNCEMENTS_KEEP = 100
+_announcements_lock = threading.Lock()
+
+def load_announcements(): return load_json(ANNOUNCEMENTS_FILE)
+def save_announcements(items): save_json(ANNOUNCEMENTS_FILE, items[-ANNOUNCEMENTS_KEEP:])
+
+def announcement_targets(target, page_slug=None, usernames=None):
+    """Destinatarios de un anuncio: 'all', 'page' (quien puede ver esa página privada) o 'users'."""
+    users = users_snapshot()
+    if target == 'users':
+        return [u for u in dict.fromkeys(usernames or []) if u in users]
+    if target == 'page':
+        page = pages_by_slug().get(page_slug)
+        if page is None: return None
+        allowed = page.get('allowed_users', [])
+        if allowed and 'all' not in allowed:
+            return [u for u in allowed if u in users]
+    return list(users)
+
+def broadcast_announcement(text, recipients, target_desc):
+    """Deja el anuncio en el buzón de cada destinatario y lo empuja por SSE a quien tenga
+    abierto su propio stream. Devuelve (anuncio, nº de envíos en directo)."""
+    ann = {'id': str(uuid.uuid4()), 'text': text, 'ts': datetime.datetime.utcnow().isoformat(),
+           'target': target_desc, 'recipients': len(recipients)}
+    live = 0
+    for name in recipients:
+        msg = inbox_add(name, text, announcement=ann['id'])
+        if sse_is_online(name) and sse_send(name, {'type': 'msg', 'text': text, 'inbox_id': msg['id'], 'announcement': ann['id']}):
+            live += 1
+    with _announcements_lock:
+        items = load_announcements(); items.append(ann); save_announcements(items)
+    return ann, live
+
+def _migrate_announcements():
+    """v7: los anuncios pendientes del formato antiguo ({'delivery': {usuario: estado}}) pasan al buzón."""
+    with _announcements_lock:
+        items = load_announcements()
+        for a in items:
+            delivery = a.pop('delivery', None)
+            if delivery is None: continue
+            for name, state in delivery.items():
+                if state == 'pending': inbox_add(name, a['text'], announcement=a['id'])
+            a['recipients'] = len(delivery)
+        save_announcements(items)
 
 PAGES_FILE = 'pages.json'
 EVENTS_FILE = 'events.json'
@@ -118,14 +665,399 @@ def load_json(filename):
     except json.JSONDecodeError: return []
 
 def save_json(filename, data):
-    with open(filename, 'w', encoding='utf-8') as f: json.dump(data, f, indent=4)
+    write_json_atomic(filename, data, indent=4)
+    invalidate_cache(filename)
 
 def load_pages(): return load_json(PAGES_FILE)
-def save_pages(pages): save_json(PAGES_FILE, pages)
+def save_pages(pages): save_json(PAGES_FILE, [normalize_page(p) for p in pages])
+def pages_snapshot(): return load_cached(PAGES_FILE, load_pages)
 def load_events(): return load_json(EVENTS_FILE)
-def save_events(events): save_json(EVENTS_FILE, events)
-def load_agenda(): return load_json(AGENDA_FILE)
-def save_agenda(notes): save_json(AGENDA_FILE, notes)
+def save_events(events): save_json(EVENTS_FILE, [normalize_event(e) for e in events])
+def events_snapshot(): return load_cached(EVENTS_FILE, load_events)
+def load_agenda(): return load_json(AGENDA_FILE)   # más recientes primero
+def agenda_snapshot(): return load_cached(AGENDA_FILE, load_agenda)
+def save_agenda(notes): save_json(AGENDA_FILE, [normalize_note(n) for n in notes])
+
+# --- ÍNDICES DE PÁGINAS (búsqueda y acceso privado) ---
+def pages_by_slug():
+    return cached_view(PAGES_FILE, 'by_slug', load_pages, lambda pages: {p['slug']: p for p in pages})
+
+# Búsqueda de módulos públicos: índice de tokens (título y asignatura, sin
+# tildes) con vocabulario ordenado para buscar por prefijo con bisect.
+SEARCH_PAGE_SIZE = 12
+
+def tokenize(text):
+    return re.findall(r'\w+', fold_text(text or ''))
+
+def page_search_index():
+    def build(pages):
+        public = [p for p in pages if not p.get('is_private')]
+        postings = {}   # {token: {posición: peso}}
+        for pos, p in enumerate(public):
+            for weight, field in ((2, p.get('title')), (1, p.get('subject'))):
+                for tok in tokenize(field):
+                    slot = postings.setdefault(tok, {})
+                    slot[pos] = max(slot.get(pos, 0), weight)
+        return {'pages': public, 'postings': postings, 'vocab': sorted(postings)}
+    return cached_view(PAGES_FILE, 'search', load_pages, build)
+
+def search_pages(q='', subject=None):
+    """Páginas públicas ordenadas por relevancia. Cada término debe coincidir (por prefijo)
+    con alguna palabra del título o la asignatura; las coincidencias exactas y en el título pesan más."""
+    index = page_search_index()
+    public = index['pages']
+    terms = tokenize(q)
+    if not terms:
+        hits = list(public)
+    else:
+        scores = None
+        for term in terms:
+            term_scores = {}
+            vocab = index['vocab']
+            i = bisect.bisect_left(vocab, term)
+            while i < len(vocab) and vocab[i].startswith(term):
+                bonus = 2 if vocab[i] == term else 1
+                for pos, weight in index['postings'][vocab[i]].items():
+                    term_scores[pos] = max(term_scores.get(pos, 0), weight * bonus)
+                i += 1
+            scores = term_scores if scores is None else {pos: sc + term_scores[pos] for pos, sc in scores.items() if pos in term_scores}
+            if not scores: return []
+        hits = [public[pos] for pos in sorted(scores, key=lambda pos: (-scores[pos], pos))]
+    if subject and subject != 'all':
+        hits = [p for p in hits if p.get('subject') == subject]
+    return hits
+
+def private_acl_index():
+    """Índice de acceso a páginas privadas, recalculado solo cuando cambia pages.json:
+    'all' → (posición, página) visibles para cualquier alumno, 'users' → {usuario: [(posición, página)]},
+    'open' → slugs privados sin lista (show_page los deja pasar; /private no los lista).
+    Guarda las propias páginas de la misma lectura: no depende de otra copia de pages.json."""
+    def build(pages):
+        index = {'all': [], 'users': {}, 'open': set(), 'slugs': {}}
+        for pos, p in enumerate(pages):
+            if not p.get('is_private'): continue
+            allowed = p.get('allowed_users', [])
+            slugs = index['slugs'].setdefault(p['slug'], set())
+            if not allowed: index['open'].add(p['slug'])
+            if 'all' in allowed: index['all'].append((pos, p)); slugs.add('all')
+            for u in allowed:
+                if u != 'all': index['users'].setdefault(u, []).append((pos, p)); slugs.add(u)
+        return index
+    return cached_view(PAGES_FILE, 'acl', load_pages, build)
+
+def private_pages_for(user):
+    """Páginas privadas que `user` ve en /private, en el orden de pages.json."""
+    acl = private_acl_index()
+    mine = acl['users'].get(user)
+    entries = sorted(dict(acl['all'] + mine).items(), key=lambda e: e[0]) if mine else acl['all']
+    return [p for _, p in entries]
+
+def can_view_private_page(slug, user):
+    acl = private_acl_index()
+    if slug in acl['open']: return True
+    allowed = acl['slugs'].get(slug, ())
+    return 'all' in allowed or user in allowed
+
+# --- ÍNDICE DE EVENTOS ---
+def event_index():
+    """Índice de events.json, recalculado solo cuando cambia el fichero: eventos ordenados por
+    fecha y por asignatura; los sueltos como intervalos ordenados por inicio ('starts' para
+    bisect, 'max_span' acota hacia atrás) y las series recurrentes aparte. 'months' y
+    'fragments' memorizan la expansión y el HTML de cada mes para esta versión de los datos."""
+    def build(events):
+        ordered = sorted(events, key=lambda e: (e.get('date') or '', e.get('title') or ''))
+        by_subject = {}
+        for e in ordered:
+            if e.get('subject'): by_subject.setdefault(e['subject'], []).append(e)
+        series = [e for e in events if e.get('repeat') in REPEAT_STEPS]
+        singles = sorted((e for e in events if e.get('repeat') not in REPEAT_STEPS and parse_date(e.get('date'))),
+                         key=lambda e: e['date'])
+        return {'events': ordered, 'by_subject': by_subject, 'series': series, 'singles': singles,
+                'starts': [e['date'] for e in singles], 'max_span': max(map(event_span, events), default=0),
+                'months': {}, 'fragments': {}}
+    return cached_view(EVENTS_FILE, 'index', load_events, build)
+
+# --- EVENTOS RECURRENTES Y DE VARIOS DÍAS ---
+# Una serie (repeat/until/exceptions) se guarda una sola vez y se expande solo
+# para el rango que se pide. Un evento dura de 'date' a 'end' (ambos incluidos).
+REPEAT_STEPS = {'weekly': 7, 'biweekly': 14}
+MAX_EVENT_DAYS = 31
+MONTH_MEMO_MAX = 48
+
+def parse_date(value):
+    try: return datetime.date.fromisoformat(value or '')
+    except ValueError: return None
+
+def event_span(e):
+    """Días que dura el evento además del primero (0 si es de un día)."""
+    start, end = parse_date(e.get('date')), parse_date(e.get('end'))
+    return max((end - start).days, 0) if start and end else 0
+
+def occurrences(e, first, last):
+    """Fechas en las que cae el evento `e` dentro de [first, last]."""
+    start = parse_date(e.get('date'))
+    if not start: return []
+    step = REPEAT_STEPS.get(e.get('repeat'))
+    if not step: return [start] if first <= start <= last else []
+    until = parse_date(e.get('until'))
+    if until and until < last: last = until
+    skip = set(e.get('exceptions') or ())
+    day = start if start >= first else start + datetime.timedelta(days=-(-(first - start).days // step) * step)
+    out = []
+    while day <= last:
+        if day.isoformat() not in skip: out.append(day)
+        day += datetime.timedelta(days=step)
+    return out
+
+def events_between(first, last):
+    """Eventos que se solapan con [first, last], ordenados por inicio. Los sueltos salen del
+    índice por bisect (inicio entre first - max_span y last); las series se expanden aquí y
+    cada ocurrencia lleva su 'date'/'end' y el inicio de la serie en 'series_start'."""
+    index = event_index()
+    starts = index['starts']
+    lo = bisect.bisect_left(starts, (first - datetime.timedelta(days=index['max_span'])).isoformat())
+    hi = bisect.bisect_right(starts, last.isoformat())
+    found = [e for e in index['singles'][lo:hi] if (e.get('end') or e['date']) >= first.isoformat()]
+    for e in index['series']:
+        span = datetime.timedelta(days=event_span(e))
+        for day in occurrences(e, first - span, last):
+            found.append(dict(e, date=day.isoformat(), end=(day + span).isoformat(), series_start=e['date']))
+    found.sort(key=lambda e: e['date'])
+    return found
+
+def month_events(year, month):
+    """{día: [eventos]} del mes; un evento de varios días aparece en cada día que ocupa."""
+    index = event_index()
+    memo = index['months']
+    days = memo.get((year, month))
+    if days is not None: return days
+    first = datetime.date(year, month, 1)
+    last = datetime.date(year, month, calendar.monthrange(year, month)[1])
+    days = {}
+    for e in events_between(first, last):
+        start = parse_date(e['date'])
+        end = min(start + datetime.timedelta(days=event_span(e)), last)
+        for n in range((end - max(start, first)).days + 1):
+            days.setdefault((max(start, first) + datetime.timedelta(days=n)).day, []).append(e)
+    if len(memo) >= MONTH_MEMO_MAX: memo.clear()
+    memo[(year, month)] = days
+    return days
+
+# --- EMBEDS DIFERIDOS ---
+# Los iframes de Genially/Drive/Canva se sustituyen al guardar la página por una
+# fachada ligera; el iframe real (con loading="lazy") se crea al hacer clic.
+IFRAME_ATTRS = {'src', 'width', 'height', 'title', 'allow', 'allowfullscreen', 'frameborder', 'style',
+                'scrolling', 'referrerpolicy', 'sandbox', 'name', 'class', 'id',
+                'mozallowfullscreen', 'webkitallowfullscreen'}
+_IFRAME_RE = re.compile(r'<iframe\b[^>]*>.*?</iframe\s*>|<iframe\b[^>]*/>', re.I | re.S)
+
+class _IframeAttrParser(HTMLParser):
+    def __init__(self):
+        super().__init__(); self.attrs = None
+    def handle_starttag(self, tag, attrs):
+        if tag == 'iframe' and self.attrs is None:
+            self.attrs = {k: (v if v is not None else '') for k, v in attrs if k in IFRAME_ATTRS}
+    handle_startendtag = handle_starttag
+
+def _css_size(value):
+    value = (value or '').strip()
+    return value + 'px' if value.isdigit() else value
+
+def _facade_html(index, attrs):
+    host = urlparse(attrs.get('src', '')).netloc.removeprefix('www.') or 'contenido externo'
+    label = attrs.get('title') or host
+    style = f"width:{_css_size(attrs.get('width')) or '100%'};height:{_css_size(attrs.get('height')) or '100%'};"
+    if not attrs.get('height'): style += 'min-height:500px;'
+    style += attrs.get('style', '')
+    return (f'<div class="embed-facade" data-embed="{index}" data-iframe="{html.escape(json.dumps(attrs))}" style="{html.escape(style)}">'
+            f'<button type="button" class="embed-facade-btn"><i class="fa-solid fa-circle-play"></i>'
+            f'<span>Cargar {html.escape(label)}</span><small>{html.escape(host)}</small></button></div>')
+
+def build_embed_facades(embed_code):
+    """{'embeds': [atributos de cada iframe], 'embed_facade': html con fachadas}, o facade None si no hay iframes."""
+    embeds = []
+    def replace(match):
+        parser = _IframeAttrParser(); parser.feed(match.group(0))
+        if not parser.attrs or not parser.attrs.get('src'): return match.group(0)
+        embeds.append(parser.attrs)
+        return _facade_html(len(embeds) - 1, parser.attrs)
+    facade = _IFRAME_RE.sub(replace, embed_code)
+    return {'embeds': embeds, 'embed_facade': facade if embeds else None}
+
+# --- MARKDOWN DE LA AGENDA ---
+# Subconjunto pequeño (títulos, listas, citas, código, enlaces, negrita y
+# cursiva). Se renderiza al guardar la nota y se guarda en 'content_html'; el
+# texto se escapa antes de dar formato y los enlaces solo admiten http(s)/mailto.
+MD_LINK_SCHEMES = ('http', 'https', 'mailto')
+_MD_CODE_RE = re.compile(r'`([^`\n]+)`')
+_MD_LINK_RE = re.compile(r'\[([^\]\n]+)\]\(([^)\s]+)\)|(https?://[^\s<]+[^\s<.,;:!?)])')
+
+def _md_inline(text):
+    out = []
+    for i, part in enumerate(_MD_CODE_RE.split(text)):
+        if i % 2:   # dentro de `código`: sin formato
+            out.append(f'<code>{html.escape(part)}</code>'); continue
+        links = []
+        def link(m):
+            label, url = (m[1], m[2]) if m[2] else (m[3], m[3])
+            if urlparse(url).scheme.lower() not in MD_LINK_SCHEMES: return m[0]   # se escapa con el resto
+            links.append(f'<a href="{html.escape(url)}" target="_blank" rel="noopener noreferrer">{html.escape(label)}</a>')
+            return f'\x00{len(links) - 1}\x00'
+        part = html.escape(_MD_LINK_RE.sub(link, part.replace('\x00', '')), quote=False)
+        part = re.sub(r'\*\*(?!\s)(.+?)(?<!\s)\*\*', r'<strong>\1</strong>', part)
+        part = re.sub(r'(?<![\w*])[*_](?![\s*_])(.+?)(?<![\s*_])[*_](?![\w*])', r'<em>\1</em>', part)
+        out.append(re.sub('\x00(\\d+)\x00', lambda m: links[int(m[1])], part))
+    return ''.join(out)
+
+def render_markdown(text):
+    """HTML seguro a partir del Markdown de una nota."""
+    out, para, code = [], [], None
+    list_tag = None
+    def flush():
+        nonlocal list_tag
+        if para: out.append('<p>' + '<br>'.join(map(_md_inline, para)) + '</p>'); para.clear()
+        if list_tag: out.append(f'</{list_tag}>'); list_tag = None
+    for line in (text or '').replace('\r\n', '\n').split('\n'):
+        stripped = line.strip()
+        if code is not None:
+            if stripped.startswith('```'): out.append('<pre><code>' + html.escape('\n'.join(code)) + '</code></pre>'); code = None
+            else: code.append(line)
+            continue
+        heading = re.match(r'(#{1,3})\s+(.+)', stripped)
+        item = re.match(r'(?:([-*+])|\d+[.)])\s+(.+)', stripped)
+        if stripped.startswith('```'):
+            flush(); code = []
+        elif heading:
+            flush(); out.append(f'<h{len(heading[1]) + 2}>{_md_inline(heading[2])}</h{len(heading[1]) + 2}>')
+        elif item:
+            tag = 'ul' if item[1] else 'ol'
+            if para or list_tag != tag: flush(); out.append(f'<{tag}>'); list_tag = tag
+            out.append(f'<li>{_md_inline(item[2])}</li>')
+        elif stripped.startswith('>'):
+            flush(); out.append(f'<blockquote>{_md_inline(stripped[1:].strip())}</blockquote>')
+        elif not stripped:
+            flush()
+        else:
+            if list_tag: flush()
+            para.append(stripped)
+    if code is not None: out.append('<pre><code>' + html.escape('\n'.join(code)) + '</code></pre>')
+    flush()
+    return '\n'.join(out)
+
+# --- ESQUEMA DE DATOS ---
+# Los registros se normalizan al escribir y, para los datos antiguos, con una
+# migración versionada que corre una vez al arrancar. Así las rutas de lectura
+# reciben registros completos y no tienen que parchearlos en cada petición.
+SCHEMA_FILE = 'schema.json'
+SCHEMA_LOCK_FILE = 'schema.lock'
+
+EVENT_TYPES = ('examen', 'tarea', 'nota')
+
+def make_event(data):
+    """Evento nuevo a partir de los campos de un formulario o de una fila importada.
+    Devuelve (evento, None) o (None, mensaje de error)."""
+    title = (data.get('title') or '').strip()
+    start = parse_date(data.get('date'))
+    if not title: return None, 'Falta el título'
+    if not start: return None, f"Fecha no válida ({data.get('date') or 'vacía'})"
+    if data.get('type') not in EVENT_TYPES: return None, f"Tipo no válido ({data.get('type') or 'vacío'})"
+    event = {'id': str(uuid.uuid4()), 'type': data['type'], 'title': title, 'date': start.isoformat(),
+             'subject': '' if data['type'] == 'nota' else (data.get('subject') or '').strip(),
+             'description': data.get('description') or ''}
+    if data.get('end'):
+        end = parse_date(data['end'])
+        if not end or end < start or end > start + datetime.timedelta(days=MAX_EVENT_DAYS):
+            return None, f"Último día no válido ({data['end']}; hasta {MAX_EVENT_DAYS} días después)"
+        event['end'] = end.isoformat()
+    if data.get('repeat') in REPEAT_STEPS:
+        event['repeat'] = data['repeat']
+        until = parse_date(data.get('until'))
+        if until and until >= start: event['until'] = until.isoformat()
+        if isinstance(data.get('exceptions'), list): event['exceptions'] = [d for d in data['exceptions'] if parse_date(d)]
+    return event, None
+
+def event_key(e):
+    """Clave natural de un evento: fecha + título + asignatura, sin tildes ni mayúsculas."""
+    return (e.get('date'), fold_text((e.get('title') or '').strip()), fold_text((e.get('subject') or '').strip()))
+
+def normalize_page(p):
+    p.setdefault('is_private', False)
+    p.setdefault('allowed_users', [])
+    if 'embed_facade' not in p: p.update(build_embed_facades(p.get('embed_code') or ''))
+    return p
+
+EVENT_OPTIONAL_FIELDS = ('end', 'repeat', 'until', 'exceptions')   # solo se guardan si tienen valor
+
+def normalize_event(e):
+    e.setdefault('subject', '')
+    e.setdefault('description', '')
+    if e.get('end') and e['end'] <= (e.get('date') or ''): del e['end']   # de un solo día
+    for k in EVENT_OPTIONAL_FIELDS:
+        if not e.get(k): e.pop(k, None)
+    return e
+
+def normalize_note(n):
+    n['title'] = n.get('title') or ''
+    n['content'] = n.get('content') or ''
+    digest = hashlib.sha1(n['content'].encode()).hexdigest()[:16]
+    if n.get('content_hash') != digest:   # solo se renderiza si el texto cambió
+        n['content_html'] = render_markdown(n['content']); n['content_hash'] = digest
+    return n
+
+def normalize_user(u):
+    u.setdefault('created_at', '')
+    u.setdefault('banned', False)
+    u.setdefault('message', None)
+    return u
+
+def _migrate_defaults():
+    """v1: rellena los campos que faltan en los registros creados antes de existir."""
+    save_pages(load_pages())
+    save_events(load_events())
+    save_agenda(load_agenda())
+    with _users_lock:
+        users = load_users()
+        save_users({name: normalize_user(u) for name, u in users.items()})
+
+def _note_time(n):
+    try: return datetime.datetime.strptime(n.get('date') or '', "%d/%m/%Y %H:%M")
+    except ValueError: return datetime.datetime.min
+
+def _migrate_agenda_order():
+    """v5: agenda guardada de más reciente a más antigua (antes se añadía al final).
+    Parte del orden de llegada, así que las notas de la misma hora (o sin fecha válida)
+    también se invierten. No es repetible: solo la lanza migrate_data, una vez, según schema.json."""
+    notes = load_agenda()
+    save_agenda([n for _, n in sorted(enumerate(notes), key=lambda p: (_note_time(p[1]), p[0]), reverse=True)])
+
+MIGRATIONS = [
+    (1, _migrate_defaults),
+    (2, lambda: save_pages(load_pages())),   # v2: fachadas de embeds precalculadas
+    (3, lambda: save_events(load_events())), # v3: campos de recurrencia en eventos
+    (4, lambda: save_events(load_events())), # v4: fecha de fin en eventos
+    (5, _migrate_agenda_order),
+    (6, lambda: save_agenda(load_agenda())), # v6: Markdown de las notas ya renderizado
+    (7, _migrate_announcements),
+    (8, lambda: save_events(load_events())), # v8: eventos sin claves opcionales vacías
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate_data():
+    """Aplica las migraciones pendientes y guarda la versión tras cada una: cada una corre una sola vez.
+    Cada worker la llama al importar el módulo: el primero migra con el bloqueo cogido y
+    los demás esperan y, al releer schema.json, ya no tienen nada que hacer."""
+    with open(SCHEMA_LOCK_FILE, 'w') as lock:
+        if fcntl: fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            meta = load_json(SCHEMA_FILE)
+            version = meta.get('version', 0) if isinstance(meta, dict) else 0
+            for target, migration in MIGRATIONS:
+                if version >= target: continue
+                migration()
+                version = target
+                save_json(SCHEMA_FILE, {'version': version})
+        finally:
+            if fcntl: fcntl.flock(lock, fcntl.LOCK_UN)
 
 # --- AFTER REQUEST: cabeceras de rendimiento ---
 @app.after_request
@@ -134,6 +1066,16 @@ def add_perf_headers(response):
         response.headers['Cache-Control'] = 'no-store'
     return response
 
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(e):
+    if request.path.startswith('/api/'):
+        resp = jsonify({'ok': False, 'error': 'Servidor ocupado, inténtalo en unos segundos.'})
+    else:
+        resp = Response('503 Service Unavailable', mimetype='text/plain')
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '2'
+    return resp
+
 # --- DECORADORES ---
 def admin_required(f):
     @wraps(f)
@@ -147,10 +1089,9 @@ def private_required(f):
     """Zona privada: necesita sesión de alumno vigente (≤5 días)."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = session.get('private_user')
+        user, u = current_private_user()
         if not user:
             return redirect(url_for('auth_wall'))
-        u = get_user(user)
         if not u or u.get('banned'):
             session.clear(); return redirect(url_for('auth_wall', reason='banned'))
         login_ts = session.get('login_ts', 0)
@@ -159,6 +1100,82 @@ def private_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- RATE LIMITING (token bucket en memoria, compartido entre hilos) ---
+# Presupuesto por ruta: (capacidad, tokens/segundo). Se puede sobrescribir con
+# la variable de entorno RATE_LIMITS, p.ej. '{"login": [5, 0.05]}'.
+RATE_LIMITS = {
+    'login':     (5, 5 / 60),     # 5 intentos seguidos, luego 5 por minuto
+    'register':  (3, 3 / 600),    # 3 cuentas seguidas, luego 3 cada 10 min
+    'chat_send': (10, 1.0),       # rafaga de 10 mensajes, luego 1 por segundo
+}
+def _parse_rate_limits(raw):
+    """{ruta: (capacidad, tokens/s)} válidos de la variable de entorno; se ignoran rutas
+    desconocidas y valores que no permitirían pasar nunca (capacidad < 1 o ritmo <= 0)."""
+    try: items = json.loads(raw).items()
+    except (ValueError, AttributeError): return {}
+    limits = {}
+    for route, value in items:
+        try: capacity, rate = float(value[0]), float(value[1])
+        except (ValueError, TypeError, IndexError, KeyError): continue
+        if route in RATE_LIMITS and capacity >= 1 and rate > 0: limits[route] = (capacity, rate)
+    return limits
+
+RATE_LIMITS.update(_parse_rate_limits(os.environ.get('RATE_LIMITS', '{}')))
+
+_RATE_MAX_BUCKETS = 20000
+_rate_buckets: dict = {}   # {(ruta, clave): [tokens, ultimo_ts]}
+_rate_lock = threading.Lock()
+
+def client_ip():
+    """IP del cliente tal y como la ve el proxy de confianza (ProxyFix ya la puso en remote_addr)."""
+    return request.remote_addr or '?'
+
+def _prune_rate_buckets(now):
+    """Descarta los buckets que ya se han rellenado del todo (equivalen a uno nuevo)."""
+    for key, (tokens, ts) in list(_rate_buckets.items()):
+        capacity, rate = RATE_LIMITS[key[0]]
+        if tokens + (now - ts) * rate >= capacity: del _rate_buckets[key]
+
+def take_token(route, key):
+    """Consume un token del bucket (route, key). Devuelve 0 si hay saldo o los segundos hasta el siguiente."""
+    capacity, rate = RATE_LIMITS[route]
+    now = time.monotonic()
+    with _rate_lock:
+        bucket = _rate_buckets.get((route, key))
+        if bucket is None:
+            if len(_rate_buckets) >= _RATE_MAX_BUCKETS: _prune_rate_buckets(now)
+            bucket = _rate_buckets[(route, key)] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+def rate_limited(route, user_key=None):
+    """Limita los POST de la ruta por IP y por usuario (el de la sesión o el que devuelva `user_key()`)."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method in ('GET', 'HEAD'): return f(*args, **kwargs)
+            keys = ['ip:' + client_ip()]
+            user = session.get('private_user') or (session.get('logged_in') and ADMIN_USER) or (user_key and user_key())
+            if user: keys.append('user:' + str(user).strip().lower())
+            wait = max([take_token(route, k) for k in keys])
+            if wait:
+                retry_after = str(max(1, math.ceil(wait)))
+                if request.path.startswith('/api/'):
+                    resp = jsonify({'ok': False, 'error': f'Demasiadas peticiones. Espera {retry_after} s.'})
+                else:
+                    resp = Response('429 Too Many Requests', mimetype='text/plain')
+                resp.status_code = 429
+                resp.headers['Retry-After'] = retry_after
+                return resp
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 # --- PLANTILLA BASE (BLINDADA CONTRA DARK MODE FORZADO) ---
 BASE_HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -1010,6 +2027,11 @@ BASE_HTML_TEMPLATE = """
     </div>
 
     <script>
+        // Una clave por carga de página: si el mismo formulario se reenvía, el servidor no lo duplica
+        document.querySelectorAll('input[name="idempotency_key"]').forEach(input => {
+            input.value = window.crypto?.randomUUID ? crypto.randomUUID() : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+        });
+
         document.addEventListener('keydown', (e) => {
             const activeTag = document.activeElement.tagName;
             const isTyping = (activeTag === 'INPUT' || activeTag === 'TEXTAREA');
@@ -1520,7 +2542,7 @@ BASE_HTML_TEMPLATE = """
                 });
                 const data = await res.json();
                 if (data.ok) {
-                    setAuthCookie({username, ts: Date.now()});
+                    setAuthCookie({username: data.username || username, ts: Date.now()});
                     okEl.textContent = _authTab === 'register'
                         ? `¡Bienvenido, ${username}! Tu cuenta ha sido creada.`
                         : `Bienvenido de nuevo, ${username}.`;
@@ -1545,9 +2567,16 @@ BASE_HTML_TEMPLATE = """
             const cookie = getAuthCookie();
             if (!cookie || !cookie.username) return;
             const es = new EventSource(`/api/sse/${encodeURIComponent(cookie.username)}`);
+            const seen = new Set();
             es.onmessage = ev => {
                 const d = JSON.parse(ev.data);
                 if (d.type === 'msg') {
+                    if (d.inbox_id) {
+                        // Confirmar al servidor para que no se reenvíe al reconectar
+                        if (seen.has(d.inbox_id)) return;
+                        seen.add(d.inbox_id);
+                        fetch('/api/inbox/ack', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ids:[d.inbox_id]})}).catch(() => {});
+                    }
                     document.getElementById('sse-toast-text').textContent = d.text;
                     document.getElementById('sse-toast').classList.remove('hidden');
                 } else if (d.type === 'kick') {
@@ -1612,6 +2641,29 @@ BASE_HTML_TEMPLATE = """
 """
 
 # --- CALENDAR TEMPLATE ---
+# Celdas del mes: se renderizan aparte para cachear el fragmento (ver calendar_grid_html)
+CALENDAR_GRID_TEMPLATE = """
+{% for week in month_days %}
+    {% for day, events in week %}
+        <div class="calendar-cell p-2 border-r border-b border-white/5 relative group {% if day == 0 %}bg-black/20{% endif %}">
+            {% if day != 0 %}
+                <span class="absolute top-2 right-2 text-xs font-mono {% if day == current_day and month == current_month and year == current_year %}text-yellow-400 font-bold bg-yellow-400/10 px-1.5 rounded{% else %}text-gray-600 group-hover:text-gray-400{% endif %}">{{ day }}</span>
+                <div class="mt-6 flex flex-col gap-1">
+                    {% for event in events %}
+                        <div onclick='openViewModal({{ event | tojson }})' class="event-pill type-{{ event.type }} truncate shadow-sm hover:shadow-md animate-enter">
+                            {% if event.type == 'examen' %}<i class="fa-solid fa-triangle-exclamation mr-1"></i>
+                            {% elif event.type == 'tarea' %}<i class="fa-solid fa-list-check mr-1"></i>
+                            {% else %}<i class="fa-solid fa-sticky-note mr-1"></i>{% endif %}
+                            {{ event.title }}
+                        </div>
+                    {% endfor %}
+                </div>
+            {% endif %}
+        </div>
+    {% endfor %}
+{% endfor %}
+"""
+
 CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}', """
 {% block content %}
 <div class="animate-enter">
@@ -1622,13 +2674,15 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
                 <i class="fa-solid fa-calendar-days text-yellow-400 text-xl"></i>
             </div>
             <div>
-                <h2 class="text-3xl font-bold text-white tracking-wide uppercase">{{ month_name }} <span class="text-gray-500">{{ year }}</span></h2>
+                <h2 id="monthTitle" class="text-3xl font-bold text-white tracking-wide uppercase">{{ month_name }} <span class="text-gray-500">{{ year }}</span></h2>
                 <div class="flex items-center gap-3 text-xs font-mono text-gray-400 mt-1">
                     <a id="btn-prev-month" href="{{ url_for('calendar_view', year=prev_year, month=prev_month) }}" class="hover:text-white transition flex items-center gap-1"><i class="fa-solid fa-chevron-left"></i> PREV</a>
                     <span class="w-[1px] h-3 bg-gray-700"></span>
                     <a id="btn-next-month" href="{{ url_for('calendar_view', year=next_year, month=next_month) }}" class="hover:text-white transition flex items-center gap-1">NEXT <i class="fa-solid fa-chevron-right"></i></a>
                     <span class="w-[1px] h-3 bg-gray-700"></span>
-                    <a href="{{ url_for('calendar_view') }}" class="text-yellow-400 hover:text-yellow-300">HOY</a>
+                    <a id="btn-today" href="{{ url_for('calendar_view') }}" class="text-yellow-400 hover:text-yellow-300">HOY</a>
+                    <span class="w-[1px] h-3 bg-gray-700"></span>
+                    <a href="{{ url_for('calendar_ics') }}" class="hover:text-white transition flex items-center gap-1" title="Suscribirse desde otra app de calendario"><i class="fa-solid fa-rss"></i> ICS</a>
                 </div>
             </div>
         </div>
@@ -1644,26 +2698,8 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
             <div class="text-xs font-bold text-gray-500 uppercase tracking-wider">{{ day }}</div>
             {% endfor %}
         </div>
-        <div class="grid grid-cols-7 auto-rows-fr bg-black/10">
-            {% for week in month_days %}
-                {% for day, events in week %}
-                    <div class="calendar-cell p-2 border-r border-b border-white/5 relative group {% if day == 0 %}bg-black/20{% endif %}">
-                        {% if day != 0 %}
-                            <span class="absolute top-2 right-2 text-xs font-mono {% if day == current_day and month == current_month and year == current_year %}text-yellow-400 font-bold bg-yellow-400/10 px-1.5 rounded{% else %}text-gray-600 group-hover:text-gray-400{% endif %}">{{ day }}</span>
-                            <div class="mt-6 flex flex-col gap-1">
-                                {% for event in events %}
-                                    <div onclick='openViewModal({{ event | tojson }})' class="event-pill type-{{ event.type }} truncate shadow-sm hover:shadow-md animate-enter">
-                                        {% if event.type == 'examen' %}<i class="fa-solid fa-triangle-exclamation mr-1"></i>
-                                        {% elif event.type == 'tarea' %}<i class="fa-solid fa-list-check mr-1"></i>
-                                        {% else %}<i class="fa-solid fa-sticky-note mr-1"></i>{% endif %}
-                                        {{ event.title }}
-                                    </div>
-                                {% endfor %}
-                            </div>
-                        {% endif %}
-                    </div>
-                {% endfor %}
-            {% endfor %}
+        <div id="calendarGrid" class="grid grid-cols-7 auto-rows-fr bg-black/10">
+            {{ grid_html | safe }}
         </div>
     </div>
 </div>
@@ -1675,6 +2711,7 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
             <button onclick="closeAddModal()" class="text-gray-500 hover:text-white"><i class="fa-solid fa-xmark"></i></button>
         </div>
         <form method="POST" action="{{ url_for('add_event') }}" class="p-6 space-y-4">
+            <input type="hidden" name="idempotency_key">
             <div class="grid grid-cols-3 gap-2 mb-4">
                 <label class="cursor-pointer">
                     <input type="radio" name="type" value="examen" class="peer sr-only" checked onchange="toggleSubject(true)">
@@ -1690,7 +2727,22 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
                 </label>
             </div>
             <div><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Título</label><input type="text" name="title" required class="w-full px-3 py-2 rounded-lg input-liquid text-sm" placeholder="Ej. Examen Tema 5"></div>
-            <div><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Fecha</label><input type="date" name="date" required class="w-full px-3 py-2 rounded-lg input-liquid text-sm text-gray-300"></div>
+            <div class="grid grid-cols-2 gap-2">
+                <div><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Fecha</label><input type="date" name="date" required class="w-full px-3 py-2 rounded-lg input-liquid text-sm text-gray-300"></div>
+                <div><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Último día <span class="normal-case font-normal">(opcional)</span></label><input type="date" name="end" class="w-full px-3 py-2 rounded-lg input-liquid text-sm text-gray-300"></div>
+            </div>
+            <div>
+                <label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Repetir</label>
+                <div class="grid grid-cols-3 gap-2">
+                    {% for value, label in [('', 'No'), ('weekly', 'Semanal'), ('biweekly', 'Quincenal')] %}
+                    <label class="cursor-pointer">
+                        <input type="radio" name="repeat" value="{{ value }}" class="peer sr-only" {% if not value %}checked{% endif %} onchange="toggleUntil({{ 'true' if value else 'false' }})">
+                        <div class="text-center py-2 rounded-lg border border-transparent bg-white/5 text-gray-400 hover:bg-white/10 peer-checked:bg-purple-500/20 peer-checked:border-purple-500 peer-checked:text-purple-300 transition-all text-xs font-bold uppercase">{{ label }}</div>
+                    </label>
+                    {% endfor %}
+                </div>
+            </div>
+            <div id="untilField" class="hidden"><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Hasta (opcional)</label><input type="date" name="until" class="w-full px-3 py-2 rounded-lg input-liquid text-sm text-gray-300"></div>
             <div id="subjectField"><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Asignatura</label><input type="text" name="subject" class="w-full px-3 py-2 rounded-lg input-liquid text-sm" placeholder="Ej. Matemáticas"></div>
             <div><label class="block text-xs font-bold text-gray-500 mb-1 uppercase">Descripción</label><textarea name="description" rows="3" class="w-full px-3 py-2 rounded-lg input-liquid text-sm resize-none" placeholder="Detalles adicionales..."></textarea></div>
             <div class="flex gap-3 pt-2">
@@ -1712,6 +2764,8 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
             <span id="viewSubject" class="text-sm font-bold text-purple-300">Mates</span>
         </div>
         <div class="mb-6"><span class="text-[0.65rem] text-gray-500 uppercase block mb-1">Descripción</span><p id="viewDesc" class="text-sm text-gray-300 leading-relaxed bg-black/20 p-3 rounded-lg border border-white/5 min-h-[60px]">Desc</p></div>
+        <p id="viewRepeat" class="hidden text-xs font-mono text-purple-300 mb-4 flex items-center gap-2"><i class="fa-solid fa-repeat"></i> <span></span></p>
+        <a id="skipBtn" href="#" onclick="return confirm('¿Quitar solo este día de la serie?')" class="hidden block w-full text-center py-2 mb-2 rounded bg-white/5 text-gray-300 text-xs font-bold border border-white/10 hover:bg-white/10 hover:text-white transition">QUITAR SOLO ESTE DÍA</a>
         <a id="deleteBtn" href="#" onclick="return confirm('¿Borrar este evento?')" class="block w-full text-center py-2 rounded bg-red-500/10 text-red-400 text-xs font-bold border border-red-500/20 hover:bg-red-500 hover:text-white transition">BORRAR ENTRADA</a>
     </div>
 </div>
@@ -1727,30 +2781,115 @@ CALENDAR_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %
         document.querySelector('#addModal input[name="title"]').focus();
     }
     function closeAddModal() { document.getElementById('addModal').classList.add('hidden'); }
+    function toggleUntil(show) { document.getElementById('untilField').classList.toggle('hidden', !show); }
     function openViewModal(event) {
         const m = document.getElementById('viewModal');
         const card = document.getElementById('viewModalCard');
         const badge = document.getElementById('viewTypeBadge');
         document.getElementById('viewTitle').innerText = event.title;
-        document.getElementById('viewDate').querySelector('span').innerText = event.date;
+        document.getElementById('viewDate').querySelector('span').innerText = event.end && event.end !== event.date ? event.date + ' → ' + event.end : event.date;
         document.getElementById('viewDesc').innerText = event.description || 'Sin descripción';
         document.getElementById('deleteBtn').href = "/delete_event/" + event.id;
+        const repeat = document.getElementById('viewRepeat'), skip = document.getElementById('skipBtn');
+        const isSeries = event.repeat === 'weekly' || event.repeat === 'biweekly';
+        repeat.classList.toggle('hidden', !isSeries); skip.classList.toggle('hidden', !isSeries);
+        if (isSeries) {
+            repeat.querySelector('span').innerText = (event.repeat === 'weekly' ? 'Cada semana' : 'Cada 2 semanas') + ' desde ' + event.series_start + (event.until ? ' hasta ' + event.until : '');
+            skip.href = "/skip_event/" + event.id + "/" + event.date;
+        }
         const subCont = document.getElementById('viewSubjectContainer');
         card.classList.remove('border-t-red-500', 'border-t-yellow-500', 'border-t-blue-500');
         badge.className = 'px-2 py-1 rounded text-[0.6rem] font-bold uppercase tracking-widest border';
 
         if(event.type === 'examen') {
             card.classList.add('border-t-red-500'); badge.classList.add('bg-red-500/10', 'border-red-500/30', 'text-red-400');
-            badge.innerText = 'EXAMEN'; subCont.style.display = 'block'; document.getElementById('viewSubject').innerText = event.subject;
+            badge.innerText = 'EXAMEN'; subCont.style.display = 'block'; document.getElementById('viewSubject').innerText = event.subject || '';
         } else if(event.type === 'tarea') {
             card.classList.add('border-t-yellow-500'); badge.classList.add('bg-yellow-500/10', 'border-yellow-500/30', 'text-yellow-400');
-            badge.innerText = 'TAREA'; subCont.style.display = 'block'; document.getElementById('viewSubject').innerText = event.subject;
+            badge.innerText = 'TAREA'; subCont.style.display = 'block'; document.getElementById('viewSubject').innerText = event.subject || '';
         } else {
             card.classList.add('border-t-blue-500'); badge.classList.add('bg-blue-500/10', 'border-blue-500/30', 'text-blue-400');
             badge.innerText = 'NOTA'; subCont.style.display = 'none';
         }
         m.classList.remove('hidden');
     }
+
+    // Navegación entre meses sin recargar: cada mes se pide una vez a /api/events
+    // y se pinta aquí; el mes inicial ya viene renderizado desde el servidor.
+    (() => {
+        const MONTHS = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"];
+        const TODAY = {y: {{ current_year }}, m: {{ current_month }}, d: {{ current_day }}};
+        const ICONS = {examen: 'fa-triangle-exclamation', tarea: 'fa-list-check'};
+        const grid = document.getElementById('calendarGrid');
+        const prev = document.getElementById('btn-prev-month'), next = document.getElementById('btn-next-month'), today = document.getElementById('btn-today');
+        const monthCache = new Map();   // 'YYYY-MM' → eventos del mes
+        const pad = n => String(n).padStart(2, '0');
+        const shift = (y, m, delta) => { const d = new Date(y, m - 1 + delta, 1); return [d.getFullYear(), d.getMonth() + 1]; };
+        const monthUrl = (y, m) => `/calendar?year=${y}&month=${m}`;
+        let view = [{{ year }}, {{ month }}];
+
+        async function loadMonth(y, m) {
+            const key = `${y}-${pad(m)}`;
+            if (!monthCache.has(key)) {
+                const r = await fetch(`/api/events?from=${key}-01&to=${key}-${pad(new Date(y, m, 0).getDate())}`);
+                if (!r.ok) throw new Error(r.status);
+                monthCache.set(key, (await r.json()).events);
+            }
+            return monthCache.get(key);
+        }
+
+        function pill(ev) {
+            const el = document.createElement('div');
+            el.className = `event-pill type-${ev.type} truncate shadow-sm hover:shadow-md animate-enter`;
+            el.innerHTML = `<i class="fa-solid ${ICONS[ev.type] || 'fa-sticky-note'} mr-1"></i>`;
+            el.append(ev.title || '');
+            el.onclick = () => openViewModal(ev);
+            return el;
+        }
+
+        function cell(y, m, day, events) {
+            const el = document.createElement('div');
+            el.className = 'calendar-cell p-2 border-r border-b border-white/5 relative group' + (day ? '' : ' bg-black/20');
+            if (!day) return el;
+            const isToday = day === TODAY.d && m === TODAY.m && y === TODAY.y;
+            el.innerHTML = `<span class="absolute top-2 right-2 text-xs font-mono ${isToday ? 'text-yellow-400 font-bold bg-yellow-400/10 px-1.5 rounded' : 'text-gray-600 group-hover:text-gray-400'}">${day}</span><div class="mt-6 flex flex-col gap-1"></div>`;
+            events.forEach(ev => el.lastChild.appendChild(pill(ev)));
+            return el;
+        }
+
+        function render(y, m, events) {
+            const last = new Date(y, m, 0).getDate();
+            const first = `${y}-${pad(m)}-01`, lastStr = `${y}-${pad(m)}-${pad(last)}`;
+            const byDay = {};
+            events.forEach(ev => {
+                const end = ev.end || ev.date;
+                const from = ev.date < first ? 1 : +ev.date.slice(8), to = end > lastStr ? last : +end.slice(8);
+                for (let d = from; d <= to; d++) (byDay[d] ||= []).push(ev);
+            });
+            const lead = (new Date(y, m - 1, 1).getDay() + 6) % 7;   // semanas de lunes a domingo
+            const frag = document.createDocumentFragment();
+            for (let i = 0; i < Math.ceil((lead + last) / 7) * 7; i++) {
+                const day = i - lead + 1;
+                frag.appendChild(cell(y, m, day >= 1 && day <= last ? day : 0, byDay[day] || []));
+            }
+            grid.replaceChildren(frag);
+            document.getElementById('monthTitle').innerHTML = `${MONTHS[m]} <span class="text-gray-500">${y}</span>`;
+            prev.href = monthUrl(...shift(y, m, -1)); next.href = monthUrl(...shift(y, m, 1));
+            view = [y, m];
+        }
+
+        async function go(y, m, push) {
+            try { render(y, m, await loadMonth(y, m)); }
+            catch (e) { location.href = monthUrl(y, m); return; }
+            if (push) history.pushState({y, m}, '', monthUrl(y, m));
+        }
+
+        prev.addEventListener('click', e => { e.preventDefault(); go(...shift(...view, -1), true); });
+        next.addEventListener('click', e => { e.preventDefault(); go(...shift(...view, 1), true); });
+        today.addEventListener('click', e => { e.preventDefault(); go(TODAY.y, TODAY.m, true); });
+        history.replaceState({y: view[0], m: view[1]}, '');
+        window.addEventListener('popstate', e => { if (e.state && e.state.y) go(e.state.y, e.state.m, false); });
+    })();
 </script>
 {% endblock %}
 """)
@@ -1768,6 +2907,7 @@ AGENDA_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}'
 
     <div class="glass-panel p-6 rounded-2xl border border-white/10 mb-12 shadow-xl">
         <form method="POST" action="{{ url_for('add_note') }}" class="space-y-4">
+            <input type="hidden" name="idempotency_key">
             <input type="text" name="title" class="w-full bg-transparent border-b border-white/10 text-xl font-bold text-white placeholder-gray-600 focus:outline-none focus:border-indigo-500 py-2 transition-colors" placeholder="Título de la nota..." required>
             <textarea name="content" class="w-full bg-black/20 rounded-lg p-4 text-sm text-gray-300 placeholder-gray-600 focus:outline-none focus:ring-1 focus:ring-indigo-500/50 resize-y min-h-[150px] custom-scrollbar" placeholder="Escribe aquí tus ideas, recordatorios o tareas..."></textarea>
             <div class="flex justify-end">
@@ -1778,12 +2918,18 @@ AGENDA_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}'
         </form>
     </div>
 
+    <div class="relative mb-8">
+        <i class="fa-solid fa-magnifying-glass absolute left-4 top-1/2 -translate-y-1/2 text-gray-500 text-sm"></i>
+        <input type="text" id="agendaSearch" placeholder="Buscar en notas y en el calendario..." class="w-full pl-11 pr-4 py-3 rounded-xl input-liquid text-sm">
+        <div id="agendaResults" class="hidden mt-3 glass-panel rounded-xl border border-white/10 divide-y divide-white/5 overflow-hidden"></div>
+    </div>
+
     <div class="mb-4 flex items-center gap-2 text-xs font-mono text-gray-500 uppercase tracking-widest">
-        <i class="fa-solid fa-box-archive"></i> Notas Guardadas ({{ notes|length }})
+        <i class="fa-solid fa-box-archive"></i> Notas Guardadas ({{ total }})
     </div>
 
     {% if notes %}
-        <div class="grid grid-cols-1 md:grid-cols-2 gap-4">
+        <div id="notesGrid" class="grid grid-cols-1 md:grid-cols-2 gap-4">
             {% for note in notes %}
             <div onclick='openNoteModal({{ note | tojson }})' class="card-dynamic glass-panel p-5 rounded-xl border-l-4 border-l-indigo-500/50 relative group cursor-pointer hover:bg-white/5 transition-all h-40 flex flex-col">
                 <div class="flex justify-between items-start mb-2">
@@ -1800,6 +2946,7 @@ AGENDA_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}'
             </div>
             {% endfor %}
         </div>
+        <button id="notesMore" onclick="loadMoreNotes()" data-cursor="{{ next_cursor or '' }}" class="{% if not next_cursor %}hidden {% endif %}w-full mt-4 py-2.5 rounded-xl bg-white/5 border border-white/10 text-gray-400 hover:text-white transition text-xs font-bold">CARGAR MÁS</button>
     {% else %}
         <div class="text-center py-12 border-2 border-dashed border-white/5 rounded-xl text-gray-600">
             <i class="fa-solid fa-feather text-2xl mb-2 opacity-50"></i>
@@ -1821,7 +2968,7 @@ AGENDA_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}'
         </div>
 
         <div class="p-8 overflow-y-auto custom-scrollbar flex-1">
-            <p id="noteModalContent" class="text-gray-300 leading-relaxed whitespace-pre-wrap text-sm md:text-base">Contenido...</p>
+            <div id="noteModalContent" class="note-md text-gray-300 leading-relaxed text-sm md:text-base">Contenido...</div>
         </div>
 
         <div class="p-4 border-t border-white/10 flex justify-end gap-3 bg-black/20">
@@ -1831,14 +2978,88 @@ AGENDA_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}'
     </div>
 </div>
 
+<style>
+    .note-md > * + * { margin-top: .75rem; }
+    .note-md h3 { font-size: 1.25rem; font-weight: 700; color: #fff; }
+    .note-md h4 { font-size: 1.1rem; font-weight: 700; color: #fff; }
+    .note-md h5 { font-weight: 700; color: #e0e7ff; }
+    .note-md ul { list-style: disc; padding-left: 1.5rem; }
+    .note-md ol { list-style: decimal; padding-left: 1.5rem; }
+    .note-md a { color: #a5b4fc; text-decoration: underline; }
+    .note-md code { font-family: monospace; font-size: .85em; background: rgba(255,255,255,0.08); padding: .1rem .3rem; border-radius: .25rem; }
+    .note-md pre { background: rgba(0,0,0,0.4); border: 1px solid rgba(255,255,255,0.08); border-radius: .5rem; padding: .75rem 1rem; overflow-x: auto; }
+    .note-md pre code { background: none; padding: 0; }
+    .note-md blockquote { border-left: 3px solid rgba(99,102,241,0.5); padding-left: .75rem; color: #9ca3af; }
+</style>
 <script>
     function openNoteModal(note) {
         document.getElementById('noteModalTitle').innerText = note.title;
         document.getElementById('noteModalDate').innerText = note.date;
-        document.getElementById('noteModalContent').innerText = note.content;
+        const body = document.getElementById('noteModalContent');
+        if (note.content_html) body.innerHTML = note.content_html;   // ya saneado en el servidor al guardar
+        else body.innerText = note.content;
         document.getElementById('noteModalDelete').href = "/delete_note/" + note.id;
         document.getElementById('noteModal').classList.remove('hidden');
     }
+    function noteCard(note) {
+        const el = document.createElement('div');
+        el.className = 'card-dynamic glass-panel p-5 rounded-xl border-l-4 border-l-indigo-500/50 relative group cursor-pointer hover:bg-white/5 transition-all h-40 flex flex-col';
+        el.innerHTML = `
+            <div class="flex justify-between items-start mb-2">
+                <h3 class="font-bold text-white text-lg leading-tight truncate pr-4"></h3>
+                <div class="text-[0.6rem] font-mono text-indigo-400 whitespace-nowrap"></div>
+            </div>
+            <div class="text-sm text-gray-400 leading-relaxed overflow-hidden line-clamp-3 flex-1 relative">
+                <span></span>
+                <div class="absolute bottom-0 left-0 w-full h-4 bg-gradient-to-t from-[#13141c] to-transparent"></div>
+            </div>
+            <div class="mt-2 text-[0.6rem] text-indigo-500 font-bold uppercase tracking-wider opacity-0 group-hover:opacity-100 transition-opacity flex justify-between items-center">
+                <span>LEER MÁS <i class="fa-solid fa-arrow-up-right-from-square ml-1"></i></span>
+            </div>`;
+        el.querySelector('h3').textContent = note.title;
+        el.querySelector('.font-mono').textContent = (note.date || '').split(' ')[0];
+        el.querySelector('.line-clamp-3 span').textContent = note.content;
+        el.onclick = () => openNoteModal(note);
+        return el;
+    }
+    (() => {
+        const input = document.getElementById('agendaSearch'), box = document.getElementById('agendaResults');
+        let timer = null, seq = 0;
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(async () => {
+                const q = input.value.trim(), mine = ++seq;
+                if (!q) { box.classList.add('hidden'); return; }
+                const d = await (await fetch('/api/search?q=' + encodeURIComponent(q))).json();
+                if (mine !== seq) return;
+                box.replaceChildren();
+                (d.results || []).forEach(r => {
+                    const row = document.createElement(r.kind === 'note' ? 'button' : 'a');
+                    row.className = 'w-full text-left flex items-center gap-3 px-4 py-3 hover:bg-white/5 transition';
+                    row.innerHTML = `<i class="fa-solid ${r.kind === 'note' ? 'fa-note-sticky text-indigo-400' : 'fa-calendar-day text-yellow-400'} text-sm"></i><span class="flex-1 min-w-0"><span class="block text-sm text-white truncate"></span><span class="block text-xs text-gray-500 truncate"></span></span><span class="text-[0.6rem] font-mono text-gray-500 whitespace-nowrap"></span>`;
+                    const spans = row.querySelectorAll('span span');
+                    spans[0].textContent = r.title;
+                    spans[1].textContent = r.kind === 'note' ? r.content : [r.subject, r.description].filter(Boolean).join(' · ');
+                    row.lastChild.textContent = (r.date || '').split(' ')[0];
+                    if (r.kind === 'note') row.onclick = () => openNoteModal(r); else row.href = r.url;
+                    box.appendChild(row);
+                });
+                if (!box.children.length) box.innerHTML = '<p class="px-4 py-3 text-xs text-gray-500">Sin resultados</p>';
+                box.classList.remove('hidden');
+            }, 150);
+        });
+    })();
+    async function loadMoreNotes() {
+        const btn = document.getElementById('notesMore');
+        btn.disabled = true;
+        try {
+            const d = await (await fetch('/api/agenda?cursor=' + encodeURIComponent(btn.dataset.cursor))).json();
+            if (!d.ok) { btn.textContent = d.error; return; }
+            d.notes.forEach(n => document.getElementById('notesGrid').appendChild(noteCard(n)));
+            btn.dataset.cursor = d.next_cursor || '';
+            btn.classList.toggle('hidden', !d.next_cursor);
+        } finally { btn.disabled = false; }
+    }
 </script>
 {% endblock %}
 """)
@@ -1992,13 +3213,9 @@ INDEX_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
         </div>
     </div>
 
-    {% set public_pages = pages | selectattr('is_private', 'false') | list %}
     <div id="modulesGrid" class="grid grid-cols-1 md:grid-cols-2 xl:grid-cols-3 gap-6 animate-enter delay-200">
-    {% if public_pages %}
-        {% for page in public_pages %}
-        <article class="module-card card-dynamic fast-glass rounded-xl overflow-hidden group h-full relative border border-white/5 hover:border-white/50"
-                 data-title="{{ page.title|lower }}"
-                 data-subject="{{ page.subject }}">
+        {% for page in pages %}
+        <article class="module-card card-dynamic fast-glass rounded-xl overflow-hidden group h-full relative border border-white/5 hover:border-white/50">
 
             <div class="absolute inset-0 {{ page.color }} blur-3xl opacity-0 group-hover:opacity-40 transition-opacity duration-300 pointer-events-none"></div>
             <a href="{{ url_for('show_page', page_slug=page.slug) }}" class="relative z-10 block h-full flex flex-col">
@@ -2018,10 +3235,10 @@ INDEX_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
             </a>
         </article>
         {% endfor %}
-    {% endif %}
     </div>
+    <div id="modulesSentinel" class="h-8"></div>
 
-    <div id="noResults" class="hidden animate-enter mt-8 fast-glass rounded-2xl p-12 text-center border-dashed border-gray-700">
+    <div id="noResults" class="{% if pages %}hidden {% endif %}animate-enter mt-8 fast-glass rounded-2xl p-12 text-center border-dashed border-gray-700">
         <h3 class="text-xl font-bold text-white mb-2">Nada por aquí...</h3>
         <p class="text-gray-500 text-sm">No encontramos módulos que coincidan con tu búsqueda.</p>
     </div>
@@ -2032,31 +3249,59 @@ INDEX_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
 
             const searchInput = document.getElementById('searchInput');
             const subjectInput = document.getElementById('subjectFilter');
-            const cards = document.querySelectorAll('.module-card');
+            const grid = document.getElementById('modulesGrid');
             const noResults = document.getElementById('noResults');
+            const PAGE_SIZE = {{ page_size }};
+            // El servidor ya pintó la primera página; el resto se pide a /api/pages/search
+            const state = {nextOffset: {{ page_size if has_more else 'null' }}, seq: 0, busy: false};
+
+            const esc = s => String(s ?? '').replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
+            function card(p) {
+                const el = document.createElement('article');
+                el.className = 'module-card card-dynamic fast-glass rounded-xl overflow-hidden group h-full relative border border-white/5 hover:border-white/50';
+                el.innerHTML = `
+                    <div class="absolute inset-0 ${esc(p.color)} blur-3xl opacity-0 group-hover:opacity-40 transition-opacity duration-300 pointer-events-none"></div>
+                    <a href="${esc(p.url)}" class="relative z-10 block h-full flex flex-col">
+                        <div class="p-6 flex items-start gap-4 ${esc(p.color)} bg-opacity-10 group-hover:bg-opacity-50 transition-all border-b border-white/5">
+                            <div class="bg-black/50 w-12 h-12 rounded-xl flex items-center justify-center border border-white/10 group-hover:scale-110 transition-transform">
+                                <i class="${esc(p.icon)} text-xl text-white"></i>
+                            </div>
+                            <div>
+                                <h3 class="text-lg font-bold text-white mb-1">${esc(p.title)}</h3>
+                                <span class="text-[0.65rem] uppercase px-2 py-0.5 rounded border border-white/10 bg-black/40">${esc(p.subject)}</span>
+                            </div>
+                        </div>
+                        <div class="p-4 mt-auto flex justify-between items-center bg-[#0a0b10]/40">
+                            <span class="text-xs font-mono text-green-400 flex items-center gap-1.5"><span class="w-1.5 h-1.5 bg-green-500 rounded-full animate-pulse"></span> ONLINE</span>
+                            <i class="fa-solid fa-arrow-right-long text-gray-500 group-hover:text-cyan-400 transition-colors"></i>
+                        </div>
+                    </a>`;
+                return el;
+            }
 
-            function filter() {
-                const term = searchInput.value.toLowerCase();
-                const subj = subjectInput.value;
-                let visible = 0;
-
-                cards.forEach(card => {
-                    const t = card.getAttribute('data-title');
-                    const s = card.getAttribute('data-subject');
-                    const matchT = t.includes(term);
-                    const matchS = subj === 'all' || s === subj;
-
-                    if(matchT && matchS) {
-                        card.style.display = ''; visible++;
-                    } else {
-                        card.style.display = 'none';
-                    }
-                });
-                noResults.classList.toggle('hidden', visible > 0);
+            async function fetchPage(offset, reset) {
+                const seq = reset ? ++state.seq : state.seq;
+                state.busy = true;
+                const params = new URLSearchParams({q: searchInput.value, subject: subjectInput.value, offset, limit: PAGE_SIZE});
+                try {
+                    const d = await (await fetch('/api/pages/search?' + params)).json();
+                    if (seq !== state.seq) return;   // respuesta de una búsqueda anterior
+                    if (reset) grid.innerHTML = '';
+                    d.results.forEach(p => grid.appendChild(card(p)));
+                    state.nextOffset = d.next_offset;
+                    noResults.classList.toggle('hidden', grid.children.length > 0);
+                } finally { if (seq === state.seq) state.busy = false; }
             }
 
+            let timer = null;
+            function filter() { clearTimeout(timer); timer = setTimeout(() => fetchPage(0, true), 150); }
             searchInput.addEventListener('input', filter);
             subjectInput.addEventListener('change', filter);
+
+            // Scroll infinito
+            new IntersectionObserver(entries => {
+                if (entries[0].isIntersecting && state.nextOffset !== null && !state.busy) fetchPage(state.nextOffset, false);
+            }, {rootMargin: '400px'}).observe(document.getElementById('modulesSentinel'));
         });
     </script>
 {% endblock %}
@@ -2065,96 +3310,550 @@ INDEX_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
 # --- RUTAS PRINCIPALES ---
 @app.route('/')
 def index():
-    pages = load_pages()
-    for p in pages:
-        if 'is_private' not in p: p['is_private'] = False
     gs_reason = request.args.get('gs_reason','')
-    return render_cached(INDEX_TEMPLATE, title='Inicio', pages=pages, url_for=url_for, session=session, subject_icons=SUBJECT_ICONS, gs_reason=gs_reason)
+    results = search_pages()
+    return render_cached(INDEX_TEMPLATE, title='Inicio', pages=results[:SEARCH_PAGE_SIZE], has_more=len(results) > SEARCH_PAGE_SIZE, page_size=SEARCH_PAGE_SIZE, url_for=url_for, session=session, subject_icons=SUBJECT_ICONS, gs_reason=gs_reason)
+
+@app.route('/api/pages/search')
+def api_pages_search():
+    """Búsqueda de módulos públicos: ?q=&subject=&offset=&limit="""
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), 50)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Parámetros no válidos'}), 400
+    hits = search_pages(request.args.get('q', ''), request.args.get('subject'))
+    cards = [{'slug': p['slug'], 'title': p['title'], 'subject': p['subject'], 'icon': p['icon'], 'color': p['color'],
+              'url': url_for('show_page', page_slug=p['slug'])} for p in hits[offset:offset + limit]]
+    next_offset = offset + limit if offset + limit < len(hits) else None
+    return jsonify({'ok': True, 'results': cards, 'total': len(hits), 'next_offset': next_offset})
+
+# API de lectura de páginas: ?fields=slug,title,... elige campos. Cada alumno ve
+# las públicas más sus privadas; el admin lo ve todo (incluido allowed_users).
+PAGE_API_FIELDS = ('slug', 'title', 'subject', 'icon', 'color', 'is_private', 'embed_code', 'allowed_users')
+PAGE_API_DEFAULT_FIELDS = ('slug', 'title', 'subject', 'icon', 'color', 'is_private')
+
+def page_api_scope():
+    """(clave de visibilidad, es_admin): entra en el ETag porque cambia lo que se ve."""
+    if session.get('logged_in'): return 'admin', True
+    name, u = current_private_user()
+    if name and u and not u.get('banned'): return 'user:' + name, False
+    return 'anon', False
+
+def page_api_fields():
+    raw = request.args.get('fields')
+    fields = tuple(f.strip() for f in raw.split(',') if f.strip()) if raw else PAGE_API_DEFAULT_FIELDS
+    if not fields or any(f not in PAGE_API_FIELDS for f in fields): return None
+    return fields
+
+def pages_api_response(key, build):
+    fields = page_api_fields()
+    if fields is None:
+        return jsonify({'ok': False, 'error': 'Campos válidos: ' + ', '.join(PAGE_API_FIELDS)}), 400
+    scope, is_admin = page_api_scope()
+    if not is_admin: fields = tuple(f for f in fields if f != 'allowed_users')
+    version = data_version(PAGES_FILE, load_pages)
+    etag = hashlib.sha1('|'.join((version, scope, key, ','.join(fields))).encode()).hexdigest()[:24]
+    pick = lambda p: {f: p.get(f) for f in fields}
+    resp = conditional(etag, lambda: build(scope, is_admin, pick))
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Cookie')
+    return resp
+
+@app.route('/api/pages')
+def api_pages():
+    def build(scope, is_admin, pick):
+        if is_admin: pages = pages_snapshot()
+        elif scope == 'anon': pages = page_search_index()['pages']
+        else:
+            mine = {p['slug'] for p in private_pages_for(scope[5:])}
+            pages = [p for p in pages_snapshot() if not p.get('is_private') or p['slug'] in mine]
+        return jsonify({'ok': True, 'pages': [pick(p) for p in pages]})
+    return pages_api_response('list', build)
+
+@app.route('/api/pages/<page_slug>')
+def api_page(page_slug):
+    page = pages_by_slug().get(page_slug)
+    scope, is_admin = page_api_scope()
+    if not page or (page.get('is_private') and not is_admin and
+                    (scope == 'anon' or not can_view_private_page(page_slug, scope[5:]))):
+        return jsonify({'ok': False, 'error': 'Página no encontrada'}), 404
+    return pages_api_response('page:' + page_slug, lambda scope, is_admin, pick: jsonify({'ok': True, 'page': pick(page)}))
 
 @app.route('/horario')
 def horario():
     return render_cached(HORARIO_TEMPLATE, title='Horario', url_for=url_for, session=session, gs_reason='')
 
 
+# Esqueleto de cada mes (semanas y meses vecinos) en un LRU pequeño; el HTML de
+# las celdas se guarda en el índice de eventos, así que caduca con events.json.
+MONTH_NAMES = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+@lru_cache(maxsize=36)
+def month_grid(year, month):
+    """(semanas de lunes a domingo con 0 fuera del mes, (año, mes) anterior, (año, mes) siguiente)."""
+    weeks = tuple(tuple(week) for week in calendar.Calendar(firstweekday=0).monthdayscalendar(year, month))
+    prev = (year - 1, 12) if month == 1 else (year, month - 1)
+    nxt = (year + 1, 1) if month == 12 else (year, month + 1)
+    return weeks, prev, nxt
+
+def calendar_grid_html(year, month, today):
+    fragments = event_index()['fragments']
+    key = (year, month, today)   # el día de hoy va resaltado en la cuadrícula
+    html_grid = fragments.get(key)
+    if html_grid is None:
+        events_by_day = month_events(year, month)
+        month_days = [[(day, events_by_day.get(day, []) if day else []) for day in week] for week in month_grid(year, month)[0]]
+        html_grid = render_cached(CALENDAR_GRID_TEMPLATE, month_days=month_days, year=year, month=month,
+                                  current_day=today.day, current_month=today.month, current_year=today.year)
+        if len(fragments) >= MONTH_MEMO_MAX: fragments.clear()
+        fragments[key] = html_grid
+    return html_grid
+
 @app.route('/calendar')
 def calendar_view():
     today = datetime.date.today()
     try: year = int(request.args.get('year', today.year)); month = int(request.args.get('month', today.month))
     except ValueError: year, month = today.year, today.month
+    if not (1 <= month <= 12 and datetime.MINYEAR < year < datetime.MAXYEAR): year, month = today.year, today.month
 
-    prev_date = datetime.date(year, month, 1) - datetime.timedelta(days=1)
-    next_date = datetime.date(year, month, 28) + datetime.timedelta(days=7); next_date = next_date.replace(day=1)
-    month_names = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-
-    cal = calendar.Calendar(firstweekday=0)
-    raw_cal = cal.monthdayscalendar(year, month)
-    all_events = load_events()
-    month_data = []
-
-    for week in raw_cal:
-        week_data = []
-        for day in week:
-            day_events = []
-            if day != 0:
-                date_str = f"{year}-{month:02d}-{day:02d}"
-                day_events = [e for e in all_events if e['date'] == date_str]
-            week_data.append((day, day_events))
-        month_data.append(week_data)
-
+    weeks, (prev_year, prev_month), (next_year, next_month) = month_grid(year, month)
     return render_cached(CALENDAR_TEMPLATE,
-        title='Calendario', year=year, month=month, month_name=month_names[month],
-        prev_year=prev_date.year, prev_month=prev_date.month, next_year=next_date.year, next_month=next_date.month,
-        month_days=month_data, current_day=today.day, current_month=today.month, current_year=today.year,
+        title='Calendario', year=year, month=month, month_name=MONTH_NAMES[month],
+        prev_year=prev_year, prev_month=prev_month, next_year=next_year, next_month=next_month,
+        grid_html=calendar_grid_html(year, month, today), current_day=today.day, current_month=today.month, current_year=today.year,
         url_for=url_for, session=session)
 
 @app.route('/add_event', methods=['POST'])
 def add_event():
-    import uuid
-    events = load_events()
-    new_event = {
-        'id': str(uuid.uuid4()), 'type': request.form.get('type'), 'title': request.form.get('title'),
-        'date': request.form.get('date'), 'subject': request.form.get('subject', ''), 'description': request.form.get('description', '')
-    }
-    if new_event['type'] == 'nota': new_event['subject'] = ''
-    events.append(new_event)
-    save_events(events)
+    new_event, error = make_event(request.form)
+    if error: return redirect(url_for('calendar_view'))
+    key = request_idempotency_key()
+    with _form_write_lock:
+        keys = record_keys(EVENTS_FILE, load_events, event_key)
+        if not (key and key in keys['request']):
+            if key: new_event['request_key'] = key
+            normalize_event(new_event)
+            events = load_events()
+            existing = keys['natural'].get(event_key(new_event))
+            changed = [new_event]
+            if existing:   # mismo evento: se actualiza conservando id y días quitados de la serie
+                for e in events:
+                    if e['id'] == existing:
+                        e.update({k: v for k, v in new_event.items() if k not in ('id', 'exceptions')}); changed = [e]
+                        for k in {'end', 'repeat', 'until'} - new_event.keys(): e.pop(k, None)
+            else:
+                events.append(new_event)
+            save_indexed('events', events, added=changed, removed=[existing] if existing else ())
     y, m, d = map(int, new_event['date'].split('-'))
     return redirect(url_for('calendar_view', year=y, month=m))
 
+@app.route('/skip_event/<event_id>/<date>')
+def skip_event(event_id, date):
+    """Quita una sola ocurrencia de una serie (la añade a sus excepciones)."""
+    day = parse_date(date)
+    if not day: return redirect(url_for('calendar_view'))
+    events = load_events()
+    for e in events:
+        if e['id'] == event_id and e.get('repeat') and date not in e.get('exceptions', ()):
+            e.setdefault('exceptions', []).append(date); save_indexed('events', events)
+            break
+    return redirect(url_for('calendar_view', year=day.year, month=day.month))
+
 @app.route('/delete_event/<event_id>')
 def delete_event(event_id):
     events = load_events()
     events = [e for e in events if e['id'] != event_id]
-    save_events(events)
+    save_indexed('events', events, removed=[event_id])
     return redirect(url_for('calendar_view'))
 
+# --- EXPORTACIÓN ICALENDAR ---
+# El .ics se genera una vez por versión de events.json (y asignatura); los
+# clientes que sondean cada pocos minutos reciben 304 por ETag/Last-Modified.
+def ics_escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+def ics_fold(line):
+    """Parte líneas de más de 75 octetos (RFC 5545 §3.1) sin cortar caracteres UTF-8."""
+    out, chunk, size = [], '', 0
+    for ch in line:
+        n = len(ch.encode('utf-8'))
+        if size + n > 75:
+            out.append(chunk); chunk, size = ' ', 1
+        chunk += ch; size += n
+    out.append(chunk)
+    return '\r\n'.join(out)
+
+def build_ics(events, name):
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//4e-web//Calendario//ES', 'CALSCALE:GREGORIAN',
+             'X-WR-CALNAME:' + ics_escape(name)]
+    for e in events:
+        try: day = datetime.date.fromisoformat(e.get('date') or '')
+        except ValueError: continue
+        lines += ['BEGIN:VEVENT', f"UID:{e['id']}@4e-web", 'DTSTAMP:' + stamp,
+                  'DTSTART;VALUE=DATE:' + day.strftime('%Y%m%d'),
+                  'DTEND;VALUE=DATE:' + (day + datetime.timedelta(days=event_span(e) + 1)).strftime('%Y%m%d'),
+                  'SUMMARY:' + ics_escape(e.get('title'))]
+        if e.get('repeat') in REPEAT_STEPS:
+            rule = 'RRULE:FREQ=WEEKLY' + (';INTERVAL=2' if e['repeat'] == 'biweekly' else '')
+            if parse_date(e.get('until')): rule += ';UNTIL=' + e['until'].replace('-', '')
+            lines.append(rule)
+            skipped = [d.replace('-', '') for d in e.get('exceptions') or () if parse_date(d)]
+            if skipped: lines.append('EXDATE;VALUE=DATE:' + ','.join(skipped))
+        if e.get('description'): lines.append('DESCRIPTION:' + ics_escape(e['description']))
+        categories = [c for c in (e.get('type'), e.get('subject')) if c]
+        if categories: lines.append('CATEGORIES:' + ','.join(ics_escape(c) for c in categories))
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(ics_fold(l) for l in lines) + '\r\n').encode('utf-8')
+
+def ics_response(subject=None):
+    index = event_index()
+    if subject is not None and subject not in index['by_subject']: return "404 Not Found", 404
+    version = data_version(EVENTS_FILE, load_events)
+    stamp = file_stamp(EVENTS_FILE)
+    last_modified = datetime.datetime.fromtimestamp(stamp[0] // 10**9, datetime.timezone.utc) if stamp else None
+    def build():
+        body = cached_view(EVENTS_FILE, ('ics', subject), load_events,
+                           lambda _: build_ics(index['by_subject'][subject] if subject else index['events'],
+                                               'Calendario 4ºE' + (f' · {subject}' if subject else '')))
+        return Response(body, mimetype='text/calendar', headers={'Content-Disposition': 'inline; filename="calendario.ics"'})
+    resp = conditional(hashlib.sha1(f'{version}|{subject}'.encode()).hexdigest()[:24], build, last_modified)
+    resp.headers['Cache-Control'] = 'public, max-age=300'
+    return resp
+
+# API de eventos por rango: ?from=AAAA-MM-DD&to=AAAA-MM-DD&subject= (JSON compacto,
+# sin campos vacíos). La usa el calendario para cambiar de mes sin recargar.
+EVENTS_API_MAX_DAYS = 400
+
+@app.route('/api/events')
+def api_events():
+    first, last = parse_date(request.args.get('from')), parse_date(request.args.get('to'))
+    # Años extremos fuera, como en calendar_view: el rango se amplía unos días hacia atrás y hacia delante
+    if not first or not last or last < first or (last - first).days > EVENTS_API_MAX_DAYS \
+            or not (datetime.MINYEAR < first.year and last.year < datetime.MAXYEAR):
+        return jsonify({'ok': False, 'error': f'Rango no válido (from/to en AAAA-MM-DD, máximo {EVENTS_API_MAX_DAYS} días)'}), 400
+    subject = request.args.get('subject')
+    version = data_version(EVENTS_FILE, load_events)
+    etag = hashlib.sha1(f'{version}|{first}|{last}|{subject}'.encode()).hexdigest()[:24]
+    def build():
+        events = events_between(first, last)
+        if subject: events = [e for e in events if e.get('subject') == subject]
+        return jsonify({'ok': True, 'events': [{k: v for k, v in e.items() if v and k not in ('exceptions', 'request_key')} for e in events]})
+    resp = conditional(etag, build)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@app.route('/calendar.ics')
+def calendar_ics(): return ics_response()
+
+@app.route('/calendar/<subject>.ics')
+def calendar_subject_ics(subject): return ics_response(subject)
+
+# --- IDEMPOTENCIA DE FORMULARIOS ---
+# Cada carga de página rellena un 'idempotency_key' en los formularios (o llega
+# la cabecera Idempotency-Key). Se guarda en el registro como 'request_key' y un
+# índice derivado del fichero dice si esa petición ya se aplicó, así que un
+# reenvío desde una conexión inestable no duplica nada. Los eventos además se
+# actualizan en vez de duplicarse si coinciden fecha, título y asignatura.
+IDEMPOTENCY_KEY_RE = re.compile(r'^[\w-]{8,64}$')
+_form_write_lock = threading.Lock()
+
+def request_idempotency_key():
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key') or ''
+    return key if IDEMPOTENCY_KEY_RE.match(key) else None
+
+def record_keys(filename, parse, natural_key=None):
+    """{'request': {request_key: id}, 'natural': {clave natural: id}}, comprobando el fichero en el momento."""
+    def build(records):
+        return {'request': {r['request_key']: r['id'] for r in records if r.get('request_key')},
+                'natural': {natural_key(r): r['id'] for r in records} if natural_key else {}}
+    return cached_view(filename, 'keys', parse, build, fresh=True)
+
+# --- IMPORTACIÓN DE EVENTOS (CSV / ICS) ---
+# El fichero se recorre fila a fila; las filas válidas y no repetidas (misma
+# fecha, título y asignatura) se añaden con una sola escritura de events.json.
+EVENT_IMPORT_MAX_ROWS = 2000
+EVENT_IMPORT_MAX_BYTES = 2 * 1024 * 1024
+CSV_COLUMNS = {'fecha': 'date', 'date': 'date', 'titulo': 'title', 'title': 'title', 'tipo': 'type', 'type': 'type',
+               'asignatura': 'subject', 'subject': 'subject', 'descripcion': 'description', 'description': 'description',
+               'fin': 'end', 'ultimo dia': 'end', 'end': 'end'}
+
+def sheet_date(value):
+    """Acepta también fechas de hoja de cálculo (31/12/2026, 31-12-2026) y las pasa a ISO."""
+    value = (value or '').strip()
+    m = re.fullmatch(r'(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})', value)
+    if m:
+        try: return datetime.date(int(m[3]), int(m[2]), int(m[1])).isoformat()
+        except ValueError: pass
+    return value
+
+def default_event_type(data):
+    kind = fold_text(data.get('type') or '').strip()
+    return kind or ('tarea' if data.get('subject') else 'nota')
+
+def iter_csv_events(stream):
+    """(línea, campos, error) por fila. La cabecera (',' o ';') necesita al menos fecha y título."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header_line = text.readline()
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    columns = [CSV_COLUMNS.get(fold_text(h).strip()) for h in next(csv.reader([header_line], delimiter=delimiter), [])]
+    if 'date' not in columns or 'title' not in columns:
+        raise ValueError('la cabecera necesita al menos las columnas fecha y título')
+    reader = csv.reader(text, delimiter=delimiter)
+    for row in reader:
+        if not any(cell.strip() for cell in row): continue
+        data = {col: cell.strip() for col, cell in zip(columns, row) if col}
+        data['date'] = sheet_date(data.get('date'))
+        data['end'] = sheet_date(data.get('end'))
+        data['type'] = default_event_type(data)
+        yield reader.line_num + 1, data, None
+
+def ics_unescape(text):
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m[1] in 'nN' else m[1], text)
+
+def _ics_lines(stream):
+    """Líneas lógicas del .ics, deshaciendo el plegado (continuaciones que empiezan por espacio)."""
+    pending = None
+    for raw in io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''):
+        line = raw.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and pending is not None:
+            pending += line[1:]; continue
+        if pending is not None: yield pending
+        pending = line
+    if pending is not None: yield pending
+
+def _ics_event_fields(props):
+    def day(value):
+        return f'{value[:4]}-{value[4:6]}-{value[6:8]}' if re.match(r'\d{8}', value or '') else value
+    data = {'title': ics_unescape(props.get('SUMMARY', '')), 'description': ics_unescape(props.get('DESCRIPTION', '')),
+            'date': day(props.get('DTSTART', ''))}
+    start, end = parse_date(data['date']), parse_date(day(props.get('DTEND', '')))
+    if start and end:
+        if 'T' not in props['DTEND']: end -= datetime.timedelta(days=1)   # DTEND de día completo es exclusivo
+        if end > start: data['end'] = end.isoformat()
+    for category in map(ics_unescape, re.split(r'(?<!\\),', props.get('CATEGORIES', ''))):
+        category = category.strip()
+        if fold_text(category) in EVENT_TYPES and 'type' not in data: data['type'] = fold_text(category)
+        elif category and 'subject' not in data: data['subject'] = category
+    data['type'] = default_event_type(data)
+    if props.get('RRULE'):
+        rule = dict(part.partition('=')[::2] for part in props['RRULE'].upper().split(';'))
+        interval = rule.get('INTERVAL', '1')
+        if rule.get('FREQ') != 'WEEKLY' or interval not in ('1', '2') or 'COUNT' in rule or ',' in rule.get('BYDAY', ''):
+            return data, 'Recurrencia no soportada (solo semanal o quincenal, con UNTIL opcional)'
+        data['repeat'] = 'weekly' if interval == '1' else 'biweekly'
+        data['until'] = day(rule.get('UNTIL', ''))
+        data['exceptions'] = [day(d.strip()) for d in props.get('EXDATE', '').split(',') if d.strip()]
+    return data, None
+
+def iter_ics_events(stream):
+    """(nº de VEVENT, campos, error) por cada VEVENT del fichero."""
+    n, props = 0, None
+    for line in _ics_lines(stream):
+        name, _, value = line.partition(':')
+        prop = name.split(';', 1)[0].upper()
+        if prop == 'BEGIN' and value.strip().upper() == 'VEVENT':
+            n += 1; props = {}
+        elif prop == 'END' and value.strip().upper() == 'VEVENT' and props is not None:
+            data, error = _ics_event_fields(props)
+            yield n, data, error
+            props = None
+        elif props is not None:
+            props.setdefault(prop, value)
+
+@app.route('/api/admin/events/import', methods=['POST'])
+@admin_required
+def api_import_events():
+    if (request.content_length or 0) > EVENT_IMPORT_MAX_BYTES:
+        return jsonify({'ok': False, 'error': f'Fichero demasiado grande (máximo {EVENT_IMPORT_MAX_BYTES // 1024 // 1024} MB)'}), 413
+    f = request.files.get('file')
+    parser = {'csv': iter_csv_events, 'ics': iter_ics_events}.get((f.filename or '').rsplit('.', 1)[-1].lower()) if f else None
+    if not parser:
+        return jsonify({'ok': False, 'error': 'Sube un fichero .csv o .ics'}), 400
+    parsed, errors, rows = [], [], 0
+    try:
+        for row, data, error in parser(f.stream):
+            rows += 1
+            if rows > EVENT_IMPORT_MAX_ROWS:
+                errors.append({'row': row, 'error': f'Límite de {EVENT_IMPORT_MAX_ROWS} filas: el resto no se ha importado'}); break
+            event = None
+            if not error: event, error = make_event(data)
+            if error: errors.append({'row': row, 'error': error})
+            else: parsed.append(event)
+    except (ValueError, csv.Error) as e:
+        return jsonify({'ok': False, 'error': f'No se pudo leer el fichero: {e}'}), 400
+    # El fichero ya está leído: ahora sí se recargan los eventos y se guarda con el mismo
+    # lock que add_event, para no pisar lo que se haya añadido mientras tanto.
+    with _form_write_lock:
+        events = load_events()
+        seen = {event_key(e) for e in events}
+        added = []
+        for event in parsed:
+            key = event_key(event)
+            if key not in seen: seen.add(key); added.append(event)
+        if added:
+            events.extend(added)
+            save_indexed('events', events, added=added)
+    duplicates = len(parsed) - len(added)
+    return jsonify({'ok': True, 'imported': len(added), 'duplicates': duplicates, 'errors': errors[:100], 'error_count': len(errors)})
+
 # --- RUTAS DE AGENDA ---
+# agenda.json ya está de más reciente a más antigua: la primera página son las
+# primeras AGENDA_PAGE_SIZE notas y el cursor es el id de la última mostrada.
+AGENDA_PAGE_SIZE = 20
+
+def agenda_page(cursor=None, limit=AGENDA_PAGE_SIZE):
+    """(notas, cursor siguiente o None). ValueError si el cursor no es válido o su nota ya no existe."""
+    notes = agenda_snapshot()
+    start = 0
+    if cursor:
+        positions = cached_view(AGENDA_FILE, 'positions', load_agenda, lambda notes: {n['id']: i for i, n in enumerate(notes)})
+        (note_id,) = decode_cursor(cursor)
+        if note_id not in positions: raise ValueError('cursor')
+        start = positions[note_id] + 1
+    page = notes[start:start + limit]
+    more = start + limit < len(notes)
+    return page, (encode_cursor((page[-1]['id'],)) if more and page else None)
+
 @app.route('/agenda')
 def agenda():
-    notes = load_agenda()
-    notes.reverse()
-    return render_cached(AGENDA_TEMPLATE, title='Agenda', notes=notes, url_for=url_for, session=session, gs_reason='')
+    notes, next_cursor = agenda_page()
+    return render_cached(AGENDA_TEMPLATE, title='Agenda', notes=notes, total=len(agenda_snapshot()), next_cursor=next_cursor,
+                         url_for=url_for, session=session, gs_reason='')
+
+@app.route('/api/agenda')
+def api_agenda():
+    try: notes, next_cursor = agenda_page(request.args.get('cursor'))
+    except ValueError: return jsonify({'ok': False, 'error': 'Cursor no válido, recarga la agenda'}), 400
+    return jsonify({'ok': True, 'notes': [{k: n[k] for k in ('id', 'title', 'content', 'content_html', 'date')} for n in notes], 'next_cursor': next_cursor})
 
 @app.route('/add_note', methods=['POST'])
 def add_note():
-    notes = load_agenda()
-    new_note = {
-        'id': str(uuid.uuid4()),
-        'title': request.form.get('title'),
-        'content': request.form.get('content'),
-        'date': datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
-    }
-    notes.append(new_note)
-    save_agenda(notes)
+    key = request_idempotency_key()
+    with _form_write_lock:
+        if key and key in record_keys(AGENDA_FILE, load_agenda)['request']: return redirect(url_for('agenda'))
+        notes = load_agenda()
+        new_note = {
+            'id': str(uuid.uuid4()),
+            'title': request.form.get('title'),
+            'content': request.form.get('content'),
+            'date': datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
+        }
+        if key: new_note['request_key'] = key
+        notes.insert(0, new_note)
+        save_indexed('notes', notes, added=[new_note])
     return redirect(url_for('agenda'))
 
 @app.route('/delete_note/<note_id>')
 def delete_note(note_id):
     notes = load_agenda()
     notes = [n for n in notes if n['id'] != note_id]
-    save_agenda(notes)
+    save_indexed('notes', notes, removed=[note_id])
     return redirect(url_for('agenda'))
 
+# --- BÚSQUEDA EN AGENDA Y CALENDARIO ---
+# Índice invertido (palabras sin tildes → ids) por fuente, en memoria de cada
+# worker. Las escrituras de este proceso lo actualizan en el sitio; si el
+# fichero cambió por otro lado (otro worker, migración) se reconstruye entero
+# en la siguiente búsqueda.
+TEXT_SEARCH_LIMIT = 20
+SEARCH_SOURCES = {
+    'notes':  (AGENDA_FILE, load_agenda, save_agenda, lambda n: (n.get('title'), n.get('content'))),
+    'events': (EVENTS_FILE, load_events, save_events, lambda e: (e.get('title'), ' '.join(filter(None, (e.get('description'), e.get('subject')))))),
+}
+_text_indexes: dict = {}   # {fuente: {'stamp', 'postings': {palabra: set(ids)}, 'vocab': [palabras ordenadas], 'docs': {id: (palabras título, palabras, registro)}}}
+_text_index_lock = threading.Lock()
+
+def _index_record(idx, fields, record):
+    title, body = fields(record)
+    title_tokens = set(tokenize(title))
+    tokens = title_tokens | set(tokenize(body))
+    idx['docs'][record['id']] = (title_tokens, tokens, dict(record))
+    for tok in tokens:
+        ids = idx['postings'].get(tok)
+        if ids is None:
+            ids = idx['postings'][tok] = set(); bisect.insort(idx['vocab'], tok)
+        ids.add(record['id'])
+
+def _unindex_record(idx, record_id):
+    doc = idx['docs'].pop(record_id, None)
+    if not doc: return
+    for tok in doc[1]:
+        ids = idx['postings'][tok]; ids.discard(record_id)
+        if not ids:
+            del idx['postings'][tok]; del idx['vocab'][bisect.bisect_left(idx['vocab'], tok)]
+
+def text_index(source):
+    """Índice de la fuente, reconstruido si el fichero no es el que se indexó. Llamar con el lock."""
+    filename, load, _, fields = SEARCH_SOURCES[source]
+    stamp = file_stamp(filename)
+    idx = _text_indexes.get(source)
+    if idx is None or idx['stamp'] != stamp:
+        idx = _text_indexes[source] = {'stamp': stamp, 'postings': {}, 'vocab': [], 'docs': {}}
+        for record in load(): _index_record(idx, fields, record)
+    return idx
+
+def save_indexed(source, records, added=(), removed=()):
+    """Guarda la fuente y aplica al índice solo el cambio (ids quitados, registros añadidos o
+    modificados). Si el índice no estaba al día con el fichero anterior, se descarta."""
+    filename, _, save, fields = SEARCH_SOURCES[source]
+    with _text_index_lock:
+        before = file_stamp(filename)
+        save(records)
+        idx = _text_indexes.get(source)
+        if idx is None: return
+        if idx['stamp'] != before:
+            _text_indexes.pop(source, None); return
+        for record_id in removed: _unindex_record(idx, record_id)
+        for record in added:
+            _unindex_record(idx, record['id']); _index_record(idx, fields, record)
+        idx['stamp'] = file_stamp(filename)
+
+def text_search(q, sources=('notes', 'events'), limit=TEXT_SEARCH_LIMIT):
+    """[(fuente, registro)] que contienen todas las palabras de `q` (por prefijo). Primero los que
+    las tienen en el título, luego los más recientes."""
+    terms = tokenize(q)
+    if not terms: return []
+    hits = []
+    with _text_index_lock:
+        for source in sources:
+            idx = text_index(source)
+            vocab, matched = idx['vocab'], None
+            for term in terms:
+                ids = set()
+                i = bisect.bisect_left(vocab, term)
+                while i < len(vocab) and vocab[i].startswith(term):
+                    ids |= idx['postings'][vocab[i]]; i += 1
+                matched = ids if matched is None else matched & ids
+                if not matched: break
+            for record_id in matched or ():
+                title_tokens, _, record = idx['docs'][record_id]
+                in_title = sum(any(t.startswith(term) for t in title_tokens) for term in terms)
+                when = _note_time(record).isoformat() if source == 'notes' else record.get('date') or ''
+                hits.append((in_title, when, source, record))
+    hits.sort(key=lambda h: (h[0], h[1]), reverse=True)
+    return [(source, record) for _, _, source, record in hits[:limit]]
+
+@app.route('/api/search')
+def api_search():
+    """Búsqueda en notas de la agenda y eventos del calendario: ?q=&type=all|notes|events"""
+    kind = request.args.get('type', 'all')
+    sources = ('notes', 'events') if kind == 'all' else (kind,) if kind in SEARCH_SOURCES else None
+    if sources is None: return jsonify({'ok': False, 'error': 'type: all, notes o events'}), 400
+    results = []
+    for source, r in text_search(request.args.get('q', ''), sources):
+        if source == 'notes':
+            results.append({'kind': 'note', 'id': r['id'], 'title': r['title'], 'date': r['date'], 'content': r['content'],
+                            'content_html': r.get('content_html'), 'url': url_for('agenda')})
+        else:
+            day = parse_date(r['date'])
+            results.append({'kind': 'event', 'id': r['id'], 'title': r['title'], 'date': r['date'], 'type': r.get('type'),
+                            'subject': r.get('subject'), 'description': r.get('description'),
+                            'url': url_for('calendar_view', year=day.year, month=day.month) if day else url_for('calendar_view')})
+    return jsonify({'ok': True, 'results': results})
+
 PAGE_DETAIL_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}', """
 {% block content %}
 <div class="max-w-5xl mx-auto animate-enter">
@@ -2177,30 +3876,50 @@ PAGE_DETAIL_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endbloc
     </div>
     <div class="glass-panel p-2 rounded-xl shadow-2xl animate-enter delay-100 border border-white/10">
         <div class="bg-black rounded-lg overflow-hidden relative min-h-[500px]">
-            {{ page.embed_code|safe }}
+            {{ (page.embed_facade or page.embed_code)|safe }}
         </div>
     </div>
 </div>
+<style>
+    .embed-facade { position:relative; max-width:100%; display:flex; align-items:center; justify-content:center;
+                    background: radial-gradient(circle at 50% 40%, rgba(168,85,247,0.18) 0%, #000 70%); }
+    .embed-facade-btn { display:flex; flex-direction:column; align-items:center; gap:.5rem; color:#e9d5ff; font-weight:700; font-size:.9rem;
+                        padding:1.5rem 2rem; border-radius:1rem; border:1px solid rgba(168,85,247,0.35); background:rgba(255,255,255,0.04); transition:all .2s; }
+    .embed-facade-btn:hover { background:rgba(168,85,247,0.15); box-shadow:0 0 24px rgba(168,85,247,0.35); }
+    .embed-facade-btn i { font-size:2.5rem; }
+    .embed-facade-btn small { font-family:monospace; font-weight:400; color:#6b7280; font-size:.65rem; }
+</style>
+<script>
+    // Sustituye cada fachada por su iframe real al hacer clic (loading="lazy")
+    document.querySelectorAll('.embed-facade').forEach(facade => {
+        facade.querySelector('button').addEventListener('click', () => {
+            const attrs = JSON.parse(facade.dataset.iframe);
+            const frame = document.createElement('iframe');
+            Object.entries(attrs).forEach(([k, v]) => frame.setAttribute(k, v));
+            frame.setAttribute('loading', 'lazy');
+            if (!attrs.style && !attrs.width) frame.style.width = '100%';
+            if (!attrs.style && !attrs.height) frame.style.height = '100%';
+            facade.replaceWith(frame);
+        });
+    });
+</script>
 {% endblock %}
 """)
 
 @app.route('/page/<page_slug>')
 def show_page(page_slug):
-    pages = load_pages()
-    page = next((p for p in pages if p['slug'] == page_slug), None)
+    page = pages_by_slug().get(page_slug)
     if not page: return "404 Not Found", 404
     if page.get('is_private'):
-        current_user = session.get('private_user')
+        current_user, u = current_private_user()
         is_admin = session.get('logged_in')
-        allowed_users = page.get('allowed_users', [])
         if not is_admin:
             if not current_user:
                 return redirect(url_for('index'))
-            u = get_user(current_user)
             if not u or u.get('banned'):
                 session.clear(); return redirect(url_for('index'))
             # 'all' means all registered users, else check whitelist
-            if allowed_users and 'all' not in allowed_users and current_user not in allowed_users:
+            if not can_view_private_page(page_slug, current_user):
                 return redirect(url_for('private_zone'))
     return render_cached(PAGE_DETAIL_TEMPLATE, title=page['title'], page=page, url_for=url_for, session=session, gs_reason='')
 
@@ -2225,10 +3944,21 @@ LOGIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
 {% endblock %}
 """)
 
+def upgrade_admin_hash(password):
+    """El hash del admin viene del código/entorno: se actualiza solo en memoria de este worker."""
+    if not needs_rehash(ADMIN_PASS_HASH): return
+    old_hash = ADMIN_PASS_HASH
+    def store(new_hash):
+        global ADMIN_PASS_HASH
+        if ADMIN_PASS_HASH == old_hash: ADMIN_PASS_HASH = new_hash
+    hash_password_later(password, store)
+
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited('login', lambda: request.form.get('username'))
 def login():
     if request.method == 'POST':
-        if request.form.get('username') == ADMIN_USER and check_password_hash(ADMIN_PASS_HASH, request.form.get('password')):
+        if request.form.get('username') == ADMIN_USER and verify_password(ADMIN_PASS_HASH, request.form.get('password') or ''):
+            upgrade_admin_hash(request.form.get('password'))
             session.clear(); session['logged_in'] = True; session['username'] = ADMIN_USER
             return redirect(url_for('admin'))
         return render_cached(LOGIN_TEMPLATE, title='Login', error='Acceso Denegado', url_for=url_for, session=session, gs_reason='')
@@ -2287,9 +4017,10 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
                 </div>
                 <div id="private_options" class="hidden p-3 bg-pink-500/10 border border-pink-500/20 rounded-lg">
                     <p class="text-xs text-gray-300 mb-2">Usuarios permitidos:</p>
-                    <div class="grid grid-cols-2 gap-2">
-                    {% for user in private_users.keys() %}
-                        <label class="text-xs text-gray-400"><input type="checkbox" name="allowed_users" value="{{ user }}" {% if edit_page and user in edit_page.allowed_users %}checked{% endif %}> {{ user }}</label>
+                    <input type="text" id="allowed-search" placeholder="Añadir alumno..." class="w-full px-3 py-2 mb-2 rounded-lg input-liquid text-xs">
+                    <div id="allowed-list" class="grid grid-cols-2 gap-2">
+                    {% for user in (edit_page.allowed_users if edit_page else []) %}
+                        <label class="text-xs text-gray-400"><input type="checkbox" name="allowed_users" value="{{ user }}" checked> {{ user }}</label>
                     {% endfor %}
                     </div>
                 </div>
@@ -2304,7 +4035,10 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
                 <i class="fa-solid fa-database mr-1.5"></i>PÁGINAS ({{ pages|length }})
             </button>
             <button onclick="adminTab('users')" id="atab-users" class="px-4 py-2 rounded-xl text-xs font-bold tracking-wider transition-all bg-white/5 border border-white/10 text-gray-400 hover:text-white hover:bg-white/10">
-                <i class="fa-solid fa-users mr-1.5"></i>USUARIOS ({{ private_users|length }})
+                <i class="fa-solid fa-users mr-1.5"></i>USUARIOS ({{ user_count }})
+            </button>
+            <button onclick="adminTab('events')" id="atab-events" class="px-4 py-2 rounded-xl text-xs font-bold tracking-wider transition-all bg-white/5 border border-white/10 text-gray-400 hover:text-white hover:bg-white/10">
+                <i class="fa-solid fa-calendar-plus mr-1.5"></i>IMPORTAR EVENTOS
             </button>
         </div>
 
@@ -2330,67 +4064,56 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
             </div>
         </div>
 
-        <!-- USERS PANEL -->
+        <!-- USERS PANEL (se carga bajo demanda desde /api/admin/users) -->
         <div id="apanel-users" class="hidden glass-panel p-6 rounded-2xl min-h-[600px]">
             <div class="flex items-center justify-between mb-5">
                 <h3 class="text-sm font-bold text-gray-400 uppercase tracking-widest">Alumnos registrados</h3>
-                <span class="text-xs text-gray-600 font-mono">{{ private_users|length }} cuenta(s)</span>
+                <div class="flex items-center gap-3">
+                    <span class="text-xs text-gray-600 font-mono">{{ user_count }} cuenta(s)</span>
+                    <button onclick="document.getElementById('annModal').classList.remove('hidden')" class="px-3 py-1.5 rounded-lg bg-purple-500/10 border border-purple-500/20 text-purple-300 text-xs font-bold hover:bg-purple-500/25 transition"><i class="fa-solid fa-bullhorn mr-1"></i>ANUNCIO</button>
+                </div>
             </div>
 
-            {% if private_users %}
-            <div class="space-y-3" id="users-list">
-                {% for uname, udata in private_users.items() %}
-                <div class="p-4 rounded-xl bg-white/5 border border-white/8 hover:border-purple-500/20 transition-all" id="urow-{{ loop.index }}">
-                    <div class="flex items-center gap-3">
-                        <!-- Avatar -->
-                        <div class="w-10 h-10 rounded-full bg-gradient-to-br from-purple-500/30 to-pink-500/20 border border-white/10 flex items-center justify-center flex-shrink-0">
-                            <span class="text-sm font-bold text-purple-300">{{ uname[0].upper() }}</span>
-                        </div>
-                        <div class="flex-1 min-w-0">
-                            <div class="flex items-center gap-2">
-                                <span class="font-bold text-sm text-white">{{ uname }}</span>
-                                {% if udata.get('banned') %}
-                                <span class="text-[0.55rem] bg-red-500/20 border border-red-500/30 text-red-400 px-2 py-0.5 rounded-full font-mono">BANEADO</span>
-                                {% endif %}
-                            </div>
-                            <p class="text-[0.6rem] text-gray-600 font-mono mt-0.5">Registrado {{ udata.get('created_at','')[:10] }}</p>
-                            {% if udata.get('message') %}
-                            <p class="text-[0.6rem] text-purple-400 mt-0.5"><i class="fa-solid fa-message mr-1"></i>{{ udata['message'] }}</p>
-                            {% endif %}
-                        </div>
-                        <!-- Actions -->
-                        <div class="flex items-center gap-1.5 flex-shrink-0">
-                            <button onclick="openMsgModal('{{ uname }}')" title="Enviar mensaje"
-                                class="w-8 h-8 rounded-lg bg-purple-500/10 border border-purple-500/20 text-purple-400 hover:bg-purple-500/25 transition flex items-center justify-center">
-                                <i class="fa-solid fa-satellite-dish text-xs"></i>
-                            </button>
-                            {% if udata.get('banned') %}
-                            <button onclick="adminAction('unban','{{ uname }}')" title="Desbanear"
-                                class="w-8 h-8 rounded-lg bg-green-500/10 border border-green-500/20 text-green-400 hover:bg-green-500/25 transition flex items-center justify-center">
-                                <i class="fa-solid fa-unlock text-xs"></i>
-                            </button>
-                            {% else %}
-                            <button onclick="adminAction('kick','{{ uname }}')" title="Banear / Expulsar"
-                                class="w-8 h-8 rounded-lg bg-yellow-500/10 border border-yellow-500/20 text-yellow-400 hover:bg-yellow-500/25 transition flex items-center justify-center">
-                                <i class="fa-solid fa-ban text-xs"></i>
-                            </button>
-                            {% endif %}
-                            <button onclick="adminAction('delete','{{ uname }}')" title="Eliminar cuenta"
-                                class="w-8 h-8 rounded-lg bg-red-500/10 border border-red-500/20 text-red-400 hover:bg-red-500/25 transition flex items-center justify-center">
-                                <i class="fa-solid fa-trash text-xs"></i>
-                            </button>
-                        </div>
-                    </div>
-                </div>
-                {% endfor %}
+            <div class="flex flex-wrap gap-2 mb-5">
+                <input type="text" id="roster-q" placeholder="Buscar por nombre..." class="flex-1 min-w-[160px] px-3 py-2 rounded-lg input-liquid text-xs">
+                <select id="roster-status" class="px-3 py-2 rounded-lg input-liquid text-xs bg-transparent">
+                    <option value="all">Todos</option><option value="active">Activos</option><option value="banned">Baneados</option>
+                </select>
+                <select id="roster-sort" class="px-3 py-2 rounded-lg input-liquid text-xs bg-transparent">
+                    <option value="name:asc">Nombre A-Z</option><option value="name:desc">Nombre Z-A</option>
+                    <option value="created:desc">Más recientes</option><option value="created:asc">Más antiguos</option>
+                </select>
+            </div>
+
+            <div id="bulk-bar" class="hidden flex flex-wrap items-center gap-2 mb-4 p-3 rounded-xl bg-purple-500/10 border border-purple-500/20">
+                <span class="text-xs text-purple-200 font-mono mr-auto"><span id="bulk-count">0</span> seleccionado(s)</span>
+                <button onclick="openMsgModal(null)" class="px-3 py-1.5 rounded-lg bg-purple-500/10 border border-purple-500/20 text-purple-300 text-xs font-bold hover:bg-purple-500/25 transition"><i class="fa-solid fa-satellite-dish mr-1"></i>MENSAJE</button>
+                <button onclick="bulkAction('ban')" class="px-3 py-1.5 rounded-lg bg-yellow-500/10 border border-yellow-500/20 text-yellow-400 text-xs font-bold hover:bg-yellow-500/25 transition"><i class="fa-solid fa-ban mr-1"></i>BANEAR</button>
+                <button onclick="bulkAction('unban')" class="px-3 py-1.5 rounded-lg bg-green-500/10 border border-green-500/20 text-green-400 text-xs font-bold hover:bg-green-500/25 transition"><i class="fa-solid fa-unlock mr-1"></i>DESBANEAR</button>
+                <button onclick="bulkAction('delete')" class="px-3 py-1.5 rounded-lg bg-red-500/10 border border-red-500/20 text-red-400 text-xs font-bold hover:bg-red-500/25 transition"><i class="fa-solid fa-trash mr-1"></i>ELIMINAR</button>
             </div>
-            {% else %}
-            <div class="flex flex-col items-center justify-center py-16 text-center opacity-50">
+            <label class="flex items-center gap-2 mb-3 text-xs text-gray-500"><input type="checkbox" id="roster-select-all"> Seleccionar los visibles</label>
+
+            <div class="space-y-3" id="users-list"></div>
+            <button id="roster-more" onclick="loadRoster(false)" class="hidden w-full mt-4 py-2.5 rounded-xl bg-white/5 border border-white/10 text-gray-400 hover:text-white transition text-xs font-bold">CARGAR MÁS</button>
+
+            <div id="roster-empty" class="hidden flex flex-col items-center justify-center py-16 text-center opacity-50">
                 <i class="fa-solid fa-users text-3xl text-gray-700 mb-3"></i>
-                <p class="text-sm text-gray-600">Aún no hay alumnos registrados</p>
+                <p class="text-sm text-gray-600">No hay alumnos que coincidan</p>
                 <p class="text-xs text-gray-700 mt-1">Aparecerán aquí cuando se registren en la web</p>
             </div>
-            {% endif %}
+        </div>
+
+        <!-- EVENTS IMPORT PANEL -->
+        <div id="apanel-events" class="hidden glass-panel p-6 rounded-2xl min-h-[600px]">
+            <h3 class="text-sm font-bold text-gray-400 uppercase tracking-widest mb-4">Importar eventos al calendario</h3>
+            <p class="text-xs text-gray-500 mb-2">CSV (separado por <code>,</code> o <code>;</code>) con cabecera: <code>fecha</code>, <code>título</code> y opcionalmente <code>tipo</code> (examen/tarea/nota), <code>asignatura</code>, <code>descripción</code>, <code>fin</code>. También vale un <code>.ics</code>.</p>
+            <p class="text-xs text-gray-600 mb-5">Los eventos con la misma fecha, título y asignatura que uno existente se omiten.</p>
+            <form id="import-form" class="flex flex-wrap items-center gap-3 mb-5">
+                <input type="file" name="file" accept=".csv,.ics" required class="flex-1 min-w-[200px] text-xs text-gray-400 file:mr-3 file:px-3 file:py-1.5 file:rounded-lg file:border-0 file:bg-white/10 file:text-gray-200">
+                <button type="submit" class="px-4 py-2 rounded-lg bg-purple-500/20 border border-purple-500/40 text-purple-200 text-xs font-bold hover:bg-purple-500/30 transition"><i class="fa-solid fa-file-import mr-1"></i>IMPORTAR</button>
+            </form>
+            <div id="import-result" class="space-y-2"></div>
         </div>
     </section>
 </div>
@@ -2408,23 +4131,182 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
     </div>
 </div>
 
+<!-- ANNOUNCEMENT MODAL -->
+<div id="annModal" class="hidden fixed inset-0 z-[150] flex items-center justify-center p-4 bg-black/70 backdrop-blur-md">
+    <div class="glass-panel w-full max-w-sm rounded-2xl border border-purple-500/30 p-6 shadow-[0_0_40px_rgba(168,85,247,0.2)]">
+        <h4 class="text-sm font-bold text-white mb-1">Anuncio</h4>
+        <p class="text-xs text-gray-500 mb-4">Se entrega al momento a quien esté conectado y al resto en su próxima visita.</p>
+        <select id="ann-target" class="w-full px-3 py-2 mb-3 rounded-lg input-liquid text-xs bg-transparent">
+            <option value="all">Todos los alumnos</option>
+            <option value="users">Alumnos seleccionados</option>
+            {% for page in pages if page.is_private %}
+            <option value="page:{{ page.slug }}">Con acceso a: {{ page.title }}</option>
+            {% endfor %}
+        </select>
+        <textarea id="ann-text" rows="3" class="w-full px-4 py-3 rounded-xl input-liquid text-sm resize-none mb-2" placeholder="Ej. Mañana examen de Biología, tema 4"></textarea>
+        <p id="ann-result" class="hidden text-xs text-green-400 mb-2"></p>
+        <div class="flex gap-3 mt-2">
+            <button onclick="sendAnnouncement()" class="flex-1 btn-glow text-white font-bold py-2.5 rounded-xl text-sm"><i class="fa-solid fa-bullhorn mr-2"></i>ENVIAR</button>
+            <button onclick="document.getElementById('annModal').classList.add('hidden')" class="px-4 py-2.5 rounded-xl bg-white/5 border border-white/10 text-gray-400 hover:text-white transition text-sm">CERRAR</button>
+        </div>
+    </div>
+</div>
+
 <script>
     let _msgTarget = '';
+    async function sendAnnouncement() {
+        const text = document.getElementById('ann-text').value.trim();
+        if (!text) return;
+        const sel = document.getElementById('ann-target').value;
+        const body = {text, target: sel.startsWith('page:') ? 'page' : sel};
+        if (body.target === 'page') body.page = sel.slice(5);
+        if (body.target === 'users') {
+            body.usernames = selectedUsers();
+            if (!body.usernames.length) { alert('Selecciona alumnos en la lista'); return; }
+        }
+        const res = await fetch('/api/admin/broadcast', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body)});
+        const d = await res.json();
+        const out = document.getElementById('ann-result');
+        out.textContent = d.ok ? `En directo a ${d.live}; ${d.queued} lo verán al conectarse.` : (d.error || 'Error');
+        out.classList.remove('hidden');
+        if (d.ok) document.getElementById('ann-text').value = '';
+    }
+    const _roster = {loaded: false, cursor: null, busy: false, seq: 0};
+    function esc(s) {
+        return String(s ?? '').replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;').replace(/'/g,'&#39;');
+    }
+    function rosterRow(u) {
+        const row = document.createElement('div');
+        row.className = 'p-4 rounded-xl bg-white/5 border border-white/8 hover:border-purple-500/20 transition-all';
+        row.innerHTML = `
+            <div class="flex items-center gap-3">
+                <input type="checkbox" class="roster-check flex-shrink-0" value="${esc(u.username)}">
+                <div class="w-10 h-10 rounded-full bg-gradient-to-br from-purple-500/30 to-pink-500/20 border border-white/10 flex items-center justify-center flex-shrink-0">
+                    <span class="text-sm font-bold text-purple-300">${esc(u.username[0].toUpperCase())}</span>
+                </div>
+                <div class="flex-1 min-w-0">
+                    <div class="flex items-center gap-2">
+                        <span class="font-bold text-sm text-white">${esc(u.username)}</span>
+                        ${u.banned ? '<span class="text-[0.55rem] bg-red-500/20 border border-red-500/30 text-red-400 px-2 py-0.5 rounded-full font-mono">BANEADO</span>' : ''}
+                    </div>
+                    <p class="text-[0.6rem] text-gray-600 font-mono mt-0.5">Registrado ${esc(u.created_at.slice(0, 10))}</p>
+                    ${u.message ? `<p class="text-[0.6rem] text-purple-400 mt-0.5"><i class="fa-solid fa-message mr-1"></i>${esc(u.message)}</p>` : ''}
+                </div>
+                <div class="flex items-center gap-1.5 flex-shrink-0">
+                    <button data-act="msg" title="Enviar mensaje" class="w-8 h-8 rounded-lg bg-purple-500/10 border border-purple-500/20 text-purple-400 hover:bg-purple-500/25 transition flex items-center justify-center"><i class="fa-solid fa-satellite-dish text-xs"></i></button>
+                    ${u.banned
+                        ? '<button data-act="unban" title="Desbanear" class="w-8 h-8 rounded-lg bg-green-500/10 border border-green-500/20 text-green-400 hover:bg-green-500/25 transition flex items-center justify-center"><i class="fa-solid fa-unlock text-xs"></i></button>'
+                        : '<button data-act="kick" title="Banear / Expulsar" class="w-8 h-8 rounded-lg bg-yellow-500/10 border border-yellow-500/20 text-yellow-400 hover:bg-yellow-500/25 transition flex items-center justify-center"><i class="fa-solid fa-ban text-xs"></i></button>'}
+                    <button data-act="delete" title="Eliminar cuenta" class="w-8 h-8 rounded-lg bg-red-500/10 border border-red-500/20 text-red-400 hover:bg-red-500/25 transition flex items-center justify-center"><i class="fa-solid fa-trash text-xs"></i></button>
+                </div>
+            </div>`;
+        row.querySelectorAll('button[data-act]').forEach(b => b.addEventListener('click', () =>
+            b.dataset.act === 'msg' ? openMsgModal(u.username) : adminAction(b.dataset.act, u.username)));
+        row.querySelector('.roster-check').addEventListener('change', updateBulkBar);
+        return row;
+    }
+    function selectedUsers() {
+        return [...document.querySelectorAll('#users-list .roster-check:checked')].map(c => c.value);
+    }
+    function updateBulkBar() {
+        const n = selectedUsers().length;
+        document.getElementById('bulk-count').textContent = n;
+        document.getElementById('bulk-bar').classList.toggle('hidden', n === 0);
+    }
+    document.getElementById('roster-select-all').addEventListener('change', e => {
+        document.querySelectorAll('#users-list .roster-check').forEach(c => c.checked = e.target.checked);
+        updateBulkBar();
+    });
+    async function bulkAction(action, text) {
+        const usernames = selectedUsers();
+        if (!usernames.length) return false;
+        const labels = {ban:'¿Banear a ', unban:'¿Desbanear a ', delete:'¿Eliminar (irreversible) las cuentas de '};
+        if (action !== 'message' && !confirm(labels[action] + usernames.length + ' alumno(s)?')) return false;
+        const res = await fetch('/api/admin/users/bulk', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({action, usernames, text})});
+        const d = await res.json();
+        if (d.ok) { document.getElementById('roster-select-all').checked = false; loadRoster(true); updateBulkBar(); }
+        return d.ok;
+    }
+    async function fetchRoster(params) {
+        const res = await fetch('/api/admin/users?' + new URLSearchParams(params));
+        return res.json();
+    }
+    async function loadRoster(reset) {
+        const list = document.getElementById('users-list');
+        if (reset) { _roster.cursor = null; _roster.seq++; list.innerHTML = ''; }
+        else if (_roster.busy) return;
+        const seq = _roster.seq;
+        _roster.busy = true;
+        const [sort, order] = document.getElementById('roster-sort').value.split(':');
+        const params = {q: document.getElementById('roster-q').value.trim(), status: document.getElementById('roster-status').value, sort, order};
+        if (_roster.cursor) params.cursor = _roster.cursor;
+        try {
+            const d = await fetchRoster(params);
+            if (seq !== _roster.seq) return;   // llegó tarde: el filtro ya cambió
+            d.users.forEach(u => list.appendChild(rosterRow(u)));
+            _roster.cursor = d.next_cursor;
+            document.getElementById('roster-more').classList.toggle('hidden', !d.next_cursor);
+            document.getElementById('roster-empty').classList.toggle('hidden', list.children.length > 0);
+        } finally { if (seq === _roster.seq) _roster.busy = false; }
+    }
+    let _rosterTimer = null;
+    ['roster-q', 'roster-status', 'roster-sort'].forEach(id => {
+        document.getElementById(id).addEventListener(id === 'roster-q' ? 'input' : 'change', () => {
+            clearTimeout(_rosterTimer); _rosterTimer = setTimeout(() => loadRoster(true), 200);
+        });
+    });
+    // Selector de usuarios permitidos: busca en el roster en vez de listar a todos los alumnos
+    let _allowedTimer = null;
+    document.getElementById('allowed-search').addEventListener('input', e => {
+        clearTimeout(_allowedTimer);
+        const q = e.target.value.trim();
+        _allowedTimer = setTimeout(async () => {
+            const list = document.getElementById('allowed-list');
+            list.querySelectorAll('label.suggested').forEach(l => { if (!l.querySelector('input').checked) l.remove(); });
+            if (!q) return;
+            const present = new Set([...list.querySelectorAll('input')].map(i => i.value));
+            const d = await fetchRoster({q, limit: 20});
+            d.users.filter(u => !present.has(u.username)).forEach(u => {
+                const label = document.createElement('label');
+                label.className = 'suggested text-xs text-gray-400';
+                label.innerHTML = `<input type="checkbox" name="allowed_users" value="${esc(u.username)}"> ${esc(u.username)}`;
+                list.appendChild(label);
+            });
+        }, 200);
+    });
     function adminTab(tab) {
-        document.getElementById('apanel-pages').classList.toggle('hidden', tab!=='pages');
-        document.getElementById('apanel-users').classList.toggle('hidden', tab!=='users');
-        document.getElementById('atab-pages').className = `px-4 py-2 rounded-xl text-xs font-bold tracking-wider transition-all ${tab==='pages' ? 'bg-purple-500/20 border border-purple-500/40 text-purple-200' : 'bg-white/5 border border-white/10 text-gray-400 hover:text-white hover:bg-white/10'}`;
-        document.getElementById('atab-users').className = `px-4 py-2 rounded-xl text-xs font-bold tracking-wider transition-all ${tab==='users' ? 'bg-purple-500/20 border border-purple-500/40 text-purple-200' : 'bg-white/5 border border-white/10 text-gray-400 hover:text-white hover:bg-white/10'}`;
+        ['pages', 'users', 'events'].forEach(t => {
+            document.getElementById('apanel-' + t).classList.toggle('hidden', tab !== t);
+            document.getElementById('atab-' + t).className = `px-4 py-2 rounded-xl text-xs font-bold tracking-wider transition-all ${tab===t ? 'bg-purple-500/20 border border-purple-500/40 text-purple-200' : 'bg-white/5 border border-white/10 text-gray-400 hover:text-white hover:bg-white/10'}`;
+        });
+        if (tab === 'users' && !_roster.loaded) { _roster.loaded = true; loadRoster(true); }
     }
+    document.getElementById('import-form').addEventListener('submit', async e => {
+        e.preventDefault();
+        const out = document.getElementById('import-result');
+        out.innerHTML = '<p class="text-xs text-gray-500 font-mono">Importando...</p>';
+        let d;
+        try { d = await (await fetch('/api/admin/events/import', {method: 'POST', body: new FormData(e.target)})).json(); }
+        catch (err) { d = {ok: false, error: 'Error de red'}; }
+        if (!d.ok) { out.innerHTML = `<p class="text-xs text-red-400">${esc(d.error)}</p>`; return; }
+        out.innerHTML = `<p class="text-sm text-green-400 font-bold">${d.imported} importado(s) · ${d.duplicates} repetido(s) · ${d.error_count} con errores</p>` +
+            d.errors.map(r => `<p class="text-xs text-red-400 font-mono">Fila ${r.row}: ${esc(r.error)}</p>`).join('') +
+            (d.error_count > d.errors.length ? `<p class="text-xs text-gray-500">… y ${d.error_count - d.errors.length} más</p>` : '');
+        e.target.reset();
+    });
     function openMsgModal(username) {
-        _msgTarget = username;
-        document.getElementById('msg-target-label').textContent = username;
+        _msgTarget = username;   // null → mensaje a la selección del roster
+        document.getElementById('msg-target-label').textContent = username ?? (selectedUsers().length + ' alumno(s)');
         document.getElementById('msg-text').value = '';
         document.getElementById('msgModal').classList.remove('hidden');
     }
     async function sendMsg() {
         const text = document.getElementById('msg-text').value.trim();
         if (!text) return;
+        if (_msgTarget === null) {
+            if (await bulkAction('message', text)) document.getElementById('msgModal').classList.add('hidden');
+            return;
+        }
         const res = await fetch('/api/admin/send_message', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({username:_msgTarget, text})});
         const d = await res.json();
         if (d.ok) { document.getElementById('msgModal').classList.add('hidden'); }
@@ -2434,7 +4316,7 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
         if (!confirm(labels[action])) return;
         const endpoints = {kick:'/api/admin/kick', delete:'/api/admin/delete_user', unban:'/api/admin/unban'};
         const res = await fetch(endpoints[action], {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({username})});
-        if ((await res.json()).ok) location.reload();
+        if ((await res.json()).ok) loadRoster(true);
     }
     const subjectIcons = {{ subject_icons | tojson }};
     const iconContainer = document.getElementById('icon-container');
@@ -2492,12 +4374,8 @@ ADMIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblock %}',
 @app.route('/admin/<edit_slug>')
 @admin_required
 def admin(edit_slug=None):
-    pages = load_pages()
-    for p in pages:
-        if 'is_private' not in p: p['is_private'] = False
-        if 'allowed_users' not in p: p['allowed_users'] = []
-    page_to_edit = next((p for p in pages if p['slug'] == edit_slug), None) if edit_slug else None
-    return render_cached(ADMIN_TEMPLATE, title='ADMIN', session=session, theme_colors=THEME_COLORS, private_users=load_users(), pages=pages, edit_page=page_to_edit, url_for=url_for, message=session.pop('message', None), subject_icons=SUBJECT_ICONS, gs_reason='')
+    page_to_edit = pages_by_slug().get(edit_slug) if edit_slug else None
+    return render_cached(ADMIN_TEMPLATE, title='ADMIN', session=session, theme_colors=THEME_COLORS, user_count=len(users_snapshot()), pages=pages_snapshot(), edit_page=page_to_edit, url_for=url_for, message=session.pop('message', None), subject_icons=SUBJECT_ICONS, gs_reason='')
 
 @app.route('/add_page', methods=['POST'])
 @admin_required
@@ -2563,7 +4441,10 @@ PRIVATE_LOGIN_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endbl
 # API ENDPOINTS — auth y SSE
 # ─────────────────────────────────────────────────────────
 
+def _json_username(): return (request.get_json(silent=True) or {}).get('username')
+
 @app.route('/api/register', methods=['POST'])
+@rate_limited('register')
 def api_register():
     data = request.get_json(silent=True) or {}
     username = (data.get('username') or '').strip()
@@ -2577,38 +4458,64 @@ def api_register():
     return jsonify({'ok': False, 'error': msg}), 400
 
 @app.route('/api/login', methods=['POST'])
+@rate_limited('login', _json_username)
 def api_login():
     data = request.get_json(silent=True) or {}
-    username = (data.get('username') or '').strip()
+    username = resolve_username((data.get('username') or '').strip())
     password = data.get('password') or ''
     u = get_user(username)
     if not u:
         return jsonify({'ok': False, 'error': 'Usuario no encontrado. ¿Te has registrado ya?'}), 401
     if u.get('banned'):
         return jsonify({'ok': False, 'error': 'Tu acceso ha sido revocado.'}), 403
-    if not check_password_hash(u['hash'], password):
+    if not verify_password(u['hash'], password):
         return jsonify({'ok': False, 'error': 'Contraseña incorrecta'}), 401
+    if needs_rehash(u['hash']): rehash_user(username, u['hash'], password)
     session['private_user'] = username
     session['login_ts'] = datetime.datetime.utcnow().timestamp()
     session.permanent = True
-    return jsonify({'ok': True})
+    return jsonify({'ok': True, 'username': username})
 
 @app.route('/api/sse/<username>')
 def api_sse(username):
     """Server-Sent Events stream per user."""
+    own_stream = session.get('private_user') == username
     def stream():
         q = get_sse_queue(username)
-        # Send initial ping
-        yield 'data: {"type":"ping"}\n\n'
-        while True:
-            try:
-                msg = q.get(timeout=20)
-                yield f'data: {json.dumps(msg)}\n\n'
-            except queue.Empty:
-                yield 'data: {"type":"ping"}\n\n'
+        # Solo cuenta como conectado el stream abierto con la sesión del propio usuario
+        if own_stream:
+            with _sse_online_lock: _sse_online[username] = _sse_online.get(username, 0) + 1
+        try:
+            # Send initial ping
+            yield 'data: {"type":"ping"}\n\n'
+            if own_stream:
+                for m in inbox_pending(username):
+                    msg = {"type": "msg", "text": m["text"], "inbox_id": m["id"]}
+                    if m.get('announcement'): msg['announcement'] = m['announcement']
+                    yield f'data: {json.dumps(msg)}\n\n'
+            while True:
+                try:
+                    msg = q.get(timeout=20)
+                    yield f'data: {json.dumps(msg)}\n\n'
+                except queue.Empty:
+                    yield 'data: {"type":"ping"}\n\n'
+        finally:
+            if own_stream:
+                with _sse_online_lock: _sse_online[username] -= 1
     return Response(stream(), mimetype='text/event-stream',
                     headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
 
+@app.route('/api/inbox/ack', methods=['POST'])
+def api_inbox_ack():
+    """El navegador confirma los mensajes del buzón que ya ha mostrado."""
+    user = session.get('private_user')
+    if not user: return jsonify({'ok': False}), 401
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+        return jsonify({'ok': False}), 400
+    inbox_ack(user, ids[:INBOX_MAX])
+    return jsonify({'ok': True})
+
 @app.route('/api/admin/send_message', methods=['POST'])
 @admin_required
 def api_send_message():
@@ -2627,35 +4534,77 @@ def api_kick():
     username = data.get('username')
     if not username:
         return jsonify({'ok': False}), 400
-    kick_user(username)
-    users = load_users()
-    if username in users:
-        users[username]['banned'] = True
-        save_users(users)
+    apply_user_action('ban', [username])
     return jsonify({'ok': True})
 
 @app.route('/api/admin/unban', methods=['POST'])
 @admin_required
 def api_unban():
     data = request.get_json(silent=True) or {}
-    username = data.get('username')
-    users = load_users()
-    if username in users:
-        users[username]['banned'] = False
-        save_users(users)
+    apply_user_action('unban', [data.get('username')])
     return jsonify({'ok': True})
 
 @app.route('/api/admin/delete_user', methods=['POST'])
 @admin_required
 def api_delete_user():
     data = request.get_json(silent=True) or {}
-    username = data.get('username')
-    users = load_users()
-    if username in users:
-        del users[username]
-        save_users(users)
+    apply_user_action('delete', [data.get('username')])
     return jsonify({'ok': True})
 
+@app.route('/api/admin/broadcast', methods=['POST'])
+@admin_required
+def api_broadcast():
+    """{text, target: all|page|users, page?: slug, usernames?: [...]} → un reparto, una escritura."""
+    data = request.get_json(silent=True) or {}
+    text = (data.get('text') or '').strip()
+    target = data.get('target', 'all')
+    if not text or target not in ('all', 'page', 'users'):
+        return jsonify({'ok': False, 'error': 'Datos incompletos'}), 400
+    recipients = announcement_targets(target, data.get('page'), data.get('usernames'))
+    if recipients is None:
+        return jsonify({'ok': False, 'error': 'Página no encontrada'}), 404
+    desc = {'all': 'all', 'page': 'page:' + str(data.get('page')), 'users': 'users'}[target]
+    ann, live = broadcast_announcement(text, recipients, desc)
+    return jsonify({'ok': True, 'id': ann['id'], 'live': live, 'queued': len(recipients) - live})
+
+@app.route('/api/admin/users/bulk', methods=['POST'])
+@admin_required
+def api_bulk_users():
+    """{action: ban|unban|delete|message, usernames: [...], text?} → una escritura para todos."""
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    usernames = data.get('usernames')
+    text = (data.get('text') or '').strip()
+    if action not in BULK_USER_ACTIONS or not isinstance(usernames, list) or not usernames \
+            or not all(isinstance(u, str) for u in usernames) or (action == 'message' and not text):
+        return jsonify({'ok': False, 'error': 'Datos incompletos'}), 400
+    if len(usernames) > BULK_MAX_USERS:
+        return jsonify({'ok': False, 'error': f'Máximo {BULK_MAX_USERS} usuarios por operación'}), 400
+    done, missing = apply_user_action(action, usernames, text or None)
+    return jsonify({'ok': True, 'applied': len(done), 'missing': missing})
+
+@app.route('/api/admin/users')
+@admin_required
+def api_admin_users():
+    """Roster paginado: ?q=prefijo&status=all|banned|active&sort=name|created&order=asc|desc&cursor=&limit="""
+    args = request.args
+    status = args.get('status', 'all')
+    sort = args.get('sort', 'name')
+    if status not in ('all', 'banned', 'active') or sort not in ('name', 'created'):
+        return jsonify({'ok': False, 'error': 'Parámetros no válidos'}), 400
+    try:
+        cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+        limit = min(max(int(args.get('limit', ROSTER_PAGE_SIZE)), 1), ROSTER_MAX_PAGE)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Parámetros no válidos'}), 400
+    rows, next_cursor = query_roster(args.get('q', '').strip(), status, sort, args.get('order') == 'desc', cursor, limit)
+    return jsonify({'ok': True, 'users': rows, 'next_cursor': next_cursor, 'total': len(users_snapshot())})
+
+@app.route('/api/admin/hash_stats')
+@admin_required
+def api_hash_stats():
+    return jsonify(hash_pool_stats())
+
 # ─────────────────────────────────────────────────────────
 # AUTH WALL page (for ?gs_reason= redirects)
 # ─────────────────────────────────────────────────────────
@@ -2706,11 +4655,8 @@ PRIVATE_ZONE_TEMPLATE = BASE_HTML_TEMPLATE.replace('{% block content %}{% endblo
 @app.route('/private')
 @private_required
 def private_zone():
-    user = session.get('private_user')
-    all_pages = load_pages()
-    # Show pages where allowed_users contains the user's name, or 'all'
-    my_pages = [p for p in all_pages if p.get('is_private') and
-                ('all' in p.get('allowed_users', []) or user in p.get('allowed_users', []))]
+    # Pages where allowed_users contains the user's name, or 'all' (índice precalculado)
+    my_pages = private_pages_for(session.get('private_user'))
     return render_cached(PRIVATE_ZONE_TEMPLATE, title='Zona Privada', pages=my_pages, url_for=url_for, session=session, gs_reason='')
 
 @app.route('/logout')
@@ -3263,6 +5209,7 @@ def api_chat_messages():
     return jsonify(load_chat())
 
 @app.route('/api/chat/send', methods=['POST'])
+@rate_limited('chat_send')
 def api_chat_send():
     user = session.get('private_user') or (session.get('logged_in') and ADMIN_USER)
     if not user: return jsonify({'ok':False,'error':'Sin sesión'}), 401
@@ -3360,6 +5307,10 @@ def api_chat_stream():
                     headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
 
 
+# Normaliza los datos antiguos una vez por arranque (cada worker de gunicorn importa el módulo).
+migrate_data()
+start_hash_calibration()
+
 if __name__ == '__main__':
     if not os.path.exists(PAGES_FILE): save_pages([])
     if not os.path.exists(EVENTS_FILE): save_events([])